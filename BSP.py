@@ -1,4 +1,19 @@
-import copy
+import threading
+from collections import deque
+
+
+# Precomputed states registry, filled at import time by the @state decorator :
+# "module.ClassQualname" -> [(method name, realm, state name), ...]
+STATES_REGISTRY = dict()
+
+
+def state(realm, name):
+    # Tag a sm_ method as the handler of state REALM:NAME
+    def decorator(func):
+        owner = func.__module__ + '.' + func.__qualname__.rsplit('.', 1)[0]
+        STATES_REGISTRY.setdefault(owner, []).append((func.__name__, realm, name))
+        return func
+    return decorator
 
 
 class SIGNALS(list):
@@ -21,13 +36,68 @@ class ENTITIES(list):
     = range(4)
 
 
+class DISPATCH(list):
+    THREAD, \
+    ASYNC, \
+    REALMS \
+    = range(3)
+
+
+class PRIORITY(list):
+    ACK, \
+    CONTROL, \
+    NORMAL, \
+    ECHO \
+    = range(4)
+
+
 class Signal :
 
+    __slots__ = ('caller', 'type', 'verb', 'payload', 'ts', 'op', 'origin', 'then', 'pooled')
+
+    # Free list used by acquire/release, so the steady state dispatch path allocates close to nothing
+    pool = []
+    pool_max = 256
+
     def __init__(self, caller=None , type='LOADSTATE', verb="IDLE", payload=""):
         self.caller = caller
         self.type = type
         self.verb = verb
         self.payload = payload
+        self.ts = 0.0
+        self.op = -1
+        # Console session the reply goes to, None means every session
+        self.origin = None
+        # Realm dispatcher : (state, payload) entries to route once this signal has run
+        self.then = None
+        self.pooled = False
+
+    @classmethod
+    def acquire(cls, caller=None , type='LOADSTATE', verb="IDLE", payload=""):
+        try:
+            signal = cls.pool.pop()
+        except IndexError:
+            signal = cls.__new__(cls)
+            signal.pooled = True
+        signal.caller = caller
+        signal.type = type
+        signal.verb = verb
+        signal.payload = payload
+        signal.ts = 0.0
+        signal.op = -1
+        signal.origin = None
+        signal.then = None
+        return signal
+
+    @classmethod
+    def release(cls, signal):
+        # Only signals obtained from acquire() go back to the pool
+        if signal.pooled and len(cls.pool) < cls.pool_max:
+            signal.caller = None
+            signal.payload = None
+            signal.origin = None
+            signal.then = None
+            cls.pool.append(signal)
 
     def setpayload(self, payload):
         self.payload = payload
@@ -39,9 +109,12 @@ class Signal :
 
 class SMState :
 
+    __slots__ = ('sname', 'sindex', 'op', 'realm', 'func', 'payloads')
+
     def __init__(self, state_name , state_index, realm, func):
         self.sname = state_name
         self.sindex = state_index
+        self.op = -1
         self.realm = realm
         self.func = func
         self.payloads = []
@@ -60,36 +133,45 @@ class SMStates:
     def __init__(self):
         self.states = list()
         self.realms = list()
+        self.byname = dict()
         self.lastindex = 0
 
     def addState(self, name, index, realm, func ):
 
         if index == 0:
-            self.states.append(SMState(name, self.lastindex, realm, func ))
+            state = SMState(name, self.lastindex, realm, func )
             self.lastindex +=1
         else:
-            self.states.append(SMState(name, index, realm, func ))
+            state = SMState(name, index, realm, func )
             self.lastindex = index
 
+        # Opcode : position in the states list, interned once at registration
+        state.op = len(self.states)
+        self.states.append(state)
+        # First registration wins, as the old linear scan did
+        if name not in self.byname:
+            self.byname[name] = state
+
         if realm not in self.realms:
             self.realms.append(realm)
 
     def sindex (self, name):
-        for tstate in self.states:
-            if tstate.sname == name:
-                return tstate.sindex
-        return -1
+        tstate = self.byname.get(name)
+        if tstate is None:
+            return -1
+        return tstate.sindex
 
     def findState(self, name) -> SMState:
-        for rstate in self.states:
-            if rstate.sname == name:
-                return rstate
-        return None
+        return self.byname.get(name)
 
     def getNewState(self, name) -> SMState :
-        for tstate in self.states:
-            if tstate.sname == name:
-                return copy.copy(tstate)
+        # Legacy copying path, the dispatcher pushes (state, payload) pairs instead
+        tstate = self.byname.get(name)
+        if tstate is not None:
+            ncopy = SMState(tstate.sname, tstate.sindex, tstate.realm, tstate.func)
+            ncopy.op = tstate.op
+            tstate = ncopy
+        return tstate
 
     def getPayload(self, index):
 
@@ -99,3 +181,165 @@ class SMStates:
 
 
 
+class POLICY(list):
+    COALESCE, \
+    DROP_OLDEST, \
+    BLOCK, \
+    REJECT \
+    = range(4)
+
+
+class SignalQueue:
+
+    # Verbs not listed here travel on the NORMAL lane
+    lanes_map = {
+                'SENDACK'       : PRIORITY.ACK,
+                'SETINSTRU'     : PRIORITY.CONTROL,
+                'SETVALVES'     : PRIORITY.CONTROL,
+                'TCPCALLBACK'   : PRIORITY.ECHO
+            }
+
+    # What to do with a signal when the queue is full. Verbs not listed here are rejected
+    #   COALESCE    : text is merged into the pending signal of the same verb (always), else drop oldest
+    #   DROP_OLDEST : the oldest pending signal of the same verb makes room, rejected if there is none
+    #   BLOCK       : the producer waits for room, callers that must not block are admitted anyway
+    policies = {
+                'TCPCALLBACK'   : POLICY.COALESCE,
+                'SENDBEACON'    : POLICY.DROP_OLDEST,
+                'SENDTICK'      : POLICY.DROP_OLDEST,
+                'SENDACK'       : POLICY.BLOCK,
+                'SETINSTRU'     : POLICY.BLOCK,
+                'SETVALVES'     : POLICY.BLOCK,
+                'STARTBC'       : POLICY.BLOCK,
+                'STOPBC'        : POLICY.BLOCK,
+                'RESTARTINSTRU' : POLICY.BLOCK,
+                'STOPINSTRU'    : POLICY.BLOCK,
+                'EXIT'          : POLICY.BLOCK
+            }
+
+    coalesce_limit = 8192
+    block_timeout = 1.0
+
+    def __init__(self, lanes_map=None, maxsize=0, policies=None):
+        if lanes_map is not None:
+            self.lanes_map = lanes_map
+        if policies is not None:
+            self.policies = policies
+        self.maxsize = maxsize
+        self.lanes = [deque() for _ in range(PRIORITY.ECHO + 1)]
+        self.mutex = threading.Lock()
+        self.lock = threading.Condition(self.mutex)
+        self.notfull = threading.Condition(self.mutex)
+        self.count = 0
+        # Waiting consumers / producers, so uncontended put and drain skip the notify calls
+        self.consumers = 0
+        self.producers = 0
+
+        self.merged = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.blocked = 0
+        self.forced = 0
+
+    def lane(self, signal) -> int:
+        return self.lanes_map.get(signal.verb, PRIORITY.NORMAL)
+
+    def put(self, signal, block=True) -> int:
+        # Returns the queue depth, or -1 if the signal was shed
+        policy = self.policies.get(signal.verb, POLICY.REJECT)
+        lane = self.lanes[self.lane(signal)]
+        with self.lock:
+            if policy == POLICY.COALESCE and lane and self.coalesce(lane[-1], signal):
+                self.merged += 1
+                Signal.release(signal)
+                return self.count
+
+            if self.maxsize and self.count >= self.maxsize:
+                if policy == POLICY.COALESCE or policy == POLICY.DROP_OLDEST:
+                    # Lanes are shared with other verbs, which must never be shed for this one
+                    if not self.evict(lane, signal.verb):
+                        self.rejected += 1
+                        return -1
+                    self.count -= 1
+                    self.dropped += 1
+                elif policy == POLICY.BLOCK:
+                    if block:
+                        self.blocked += 1
+                        self.producers += 1
+                        room = self.notfull.wait_for(lambda: self.count < self.maxsize, self.block_timeout)
+                        self.producers -= 1
+                        if not room:
+                            self.rejected += 1
+                            return -1
+                    else:
+                        self.forced += 1
+                else:
+                    self.rejected += 1
+                    return -1
+
+            lane.append(signal)
+            self.count += 1
+            if self.consumers:
+                self.lock.notify()
+            return self.count
+
+    @staticmethod
+    def evict(lane, verb) -> bool:
+        for n, pending in enumerate(lane):
+            if pending.verb == verb:
+                del lane[n]
+                Signal.release(pending)
+                return True
+        return False
+
+    def coalesce(self, tail, signal) -> bool:
+        if tail.verb != signal.verb or tail.origin is not signal.origin:
+            return False
+        if not isinstance(tail.payload, str) or not isinstance(signal.payload, str):
+            return False
+        if len(tail.payload) > self.coalesce_limit:
+            return False
+        sep = '' if tail.payload.endswith(('\n', '\r')) else '\n\r'
+        tail.payload = tail.payload + sep + signal.payload
+        return True
+
+    def counters(self) -> dict:
+        return {
+            'depth'     : self.count,
+            'maxsize'   : self.maxsize,
+            'merged'    : self.merged,
+            'dropped'   : self.dropped,
+            'rejected'  : self.rejected,
+            'blocked'   : self.blocked,
+            'forced'    : self.forced,
+        }
+
+    def drain(self, limit=0) -> list:
+        # Pop up to limit signals (all of them if limit is 0), highest priority lane first
+        with self.lock:
+            return self._drain(limit)
+
+    def wait(self, limit=0, timeout=None) -> list:
+        # Blocking drain : waits up to timeout seconds for at least one signal
+        with self.lock:
+            if self.count == 0:
+                self.consumers += 1
+                self.lock.wait(timeout)
+                self.consumers -= 1
+            return self._drain(limit)
+
+    def _drain(self, limit):
+        out = []
+        for lane in self.lanes:
+            while lane and (limit == 0 or len(out) < limit):
+                out.append(lane.popleft())
+        self.count -= len(out)
+        if out and self.producers:
+            self.notfull.notify_all()
+        return out
+
+    def empty(self) -> bool:
+        return self.count == 0
+
+    def qsize(self) -> int:
+        return self.count
@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from Stubs import buildStubStack
+from BSP import DISPATCH, Signal
+
+
+def quietLoggers():
+    for name in ('RunSM', 'PSerial', 'TCPServer', 'Instrument', 'Stubs'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def benchDispatch(n):
+    # Cost of one signal through registerSignal + runBatch on a no-op state, plain vs pooled signals
+    sm = buildStubStack(DISPATCH.ASYNC)
+    quietLoggers()
+    sm.runBatch()
+
+    probe = Signal(None, verb='INIT')
+    print('Signal instance size : {} bytes (__slots__, no __dict__ : {})'.format(
+            sys.getsizeof(probe), not hasattr(probe, '__dict__')))
+
+    for label, make in (('Signal()', Signal), ('Signal.acquire()', Signal.acquire)):
+        for _ in range(1000):
+            sm.registerSignal(make(None, verb='INIT'))
+            sm.runBatch()
+
+        t0 = time.perf_counter()
+        for _ in range(n):
+            sm.registerSignal(make(None, verb='INIT'))
+            sm.runBatch()
+        elapsed = time.perf_counter() - t0
+
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        for _ in range(1000):
+            sm.registerSignal(make(None, verb='INIT'))
+            sm.runBatch()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('{:<18} {:>8.3f} us/dispatch   {:>10.0f} dispatch/s   peak {:>6} B, retained {:>6} B over 1000 dispatches'.format(
+                label, elapsed / n * 1e6, n / elapsed, peak - base, current - base))
+
+
+def percentile(samples, p):
+    # samples sorted
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def benchRtt(n):
+    # Console command round trip (line sent -> next prompt read) over TCP loopback and a Unix socket,
+    # both listeners attached to the same RunSM
+    sm = buildStubStack(DISPATCH.ASYNC)
+    quietLoggers()
+    logging.getLogger('TCPServer').setLevel(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sm.go(loop)
+
+    tcps = sm.tcpserver
+    prompt = bytes(tcps.prompt, 'utf8')
+    path = os.path.join(tempfile.mkdtemp(), 'console.sock')
+
+    async def roundTrips(reader, writer):
+        await reader.readuntil(prompt)
+        for _ in range(200):
+            writer.write(b'HISTORY 1\r\n')
+            await reader.readuntil(prompt)
+        samples = list()
+        for _ in range(n):
+            t0 = time.perf_counter()
+            writer.write(b'HISTORY 1\r\n')
+            await reader.readuntil(prompt)
+            samples.append(time.perf_counter() - t0)
+        writer.close()
+        return sorted(samples)
+
+    async def run():
+        tcp = await tcps.listen(loop, 'tcp:127.0.0.1:0')
+        port = tcp.sockets[0].getsockname()[1]
+        await tcps.listen(loop, 'unix:' + path)
+
+        results = dict()
+        results['tcp loopback'] = await roundTrips(*await asyncio.open_connection('127.0.0.1', port))
+        results['unix socket'] = await roundTrips(*await asyncio.open_unix_connection(path))
+        return results
+
+    for label, samples in loop.run_until_complete(run()).items():
+        print('{:<12} {:>8.1f} us mean   p50 {:>8.1f} us   p99 {:>8.1f} us   {:>8.0f} commands/s'.format(
+                label, sum(samples) / n * 1e6, percentile(samples, 50) * 1e6, percentile(samples, 99) * 1e6,
+                n / sum(samples)))
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+
+
+def benchEncode(n):
+    # n tick frames : getBytes per frame (as SENDBLOCK used to) against the bulk getTicksBytes
+    import numpy as np
+    from Payload import Payload
+
+    payload = Payload()
+    ticks = np.random.default_rng(0).integers(-2**40, 2**40, n)
+    cmds = ['' if i % 4 else 'CMD{}'.format(i % 7) for i in range(n)]
+
+    for label, cmdlist in (('ticks', None), ('ticks + cmds', cmds)):
+        t0 = time.perf_counter()
+        if cmdlist is None:
+            loop = b''.join(payload.getBytes(None, int(t)) for t in ticks)
+        else:
+            loop = b''.join(payload.getBytes(None, int(t), c) for t, c in zip(ticks, cmdlist))
+        t_loop = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        bulk = payload.getTicksBytes(ticks, cmdlist)
+        t_bulk = time.perf_counter() - t0
+
+        print('{:<14} {} frames, {} bytes, identical {}   getBytes loop {:>9.3f} ms   getTicksBytes {:>9.3f} ms   x{:.1f}'.format(
+                label, n, len(bulk), bulk == loop, t_loop * 1000, t_bulk * 1000, t_loop / t_bulk))
+
+
+BENCHES = {
+    'dispatch'  : benchDispatch,
+    'rtt'       : benchRtt,
+    'encode'    : benchEncode,
+}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='CLICalcServer micro benchmarks')
+    parser.add_argument('bench', choices=sorted(BENCHES.keys()))
+    parser.add_argument('-n', type=int, default=100000, help='iterations')
+    args = parser.parse_args()
+
+    BENCHES[args.bench](args.n)
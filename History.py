@@ -0,0 +1,102 @@
+import logging
+import os
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryRing:
+
+    # Last `size` commands of one console session. Entries are numbered from 1 for the
+    # whole life of the session, so !n keeps pointing at the same command while the ring rolls
+
+    def __init__(self, size=64):
+        self.ring = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, line):
+        if not line or (self.ring and self.ring[-1] == line):
+            return
+        self.ring.append(line)
+        self.count += 1
+
+    def first(self) -> int:
+        return self.count - len(self.ring) + 1
+
+    def get(self, n):
+        # Command number n, or None once it has rolled out of the ring
+        if n < 0:
+            n = self.count + 1 + n
+        if self.first() <= n <= self.count:
+            return self.ring[n - self.first()]
+        return None
+
+    def entries(self, last=None) -> list:
+        # [(n, line), ...] oldest first
+        items = list(enumerate(self.ring, self.first()))
+        return items if last is None else items[-last:]
+
+
+class SharedHistory(HistoryRing):
+
+    # History shared by every session and kept across restarts in an append only file,
+    # one command per line. Nothing is read until the first lookup : adds before that
+    # only append to the file, which the lazy load then picks up
+
+    def __init__(self, path, size=512):
+        super().__init__(size)
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.fobj = None
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if not os.path.exists(self.path):
+                return
+            with open(self.path, 'r', encoding='utf8', errors='replace') as fobj:
+                lines = 0
+                for line in fobj:
+                    lines += 1
+                    self.ring.append(line.rstrip('\n'))
+            self.count = len(self.ring)
+
+            if lines > 2 * self.ring.maxlen:
+                # Keep the file bounded : rewrite it with the tail we hold
+                self.close()
+                with open(self.path, 'w', encoding='utf8') as fobj:
+                    fobj.writelines(line + '\n' for line in self.ring)
+                logger.info("History {} compacted from {} to {} lines".format(self.path, lines, len(self.ring)))
+
+    def add(self, line):
+        if not line:
+            return
+        with self.lock:
+            if self.loaded:
+                if self.ring and self.ring[-1] == line:
+                    return
+                self.ring.append(line)
+                self.count += 1
+            try:
+                if self.fobj is None:
+                    self.fobj = open(self.path, 'a', encoding='utf8', buffering=1)
+                self.fobj.write(line + '\n')
+            except OSError as e:
+                logger.info("History {} not written due: {}".format(self.path, e.__repr__()))
+
+    def get(self, n):
+        self.load()
+        return super().get(n)
+
+    def entries(self, last=None) -> list:
+        self.load()
+        return super().entries(last)
+
+    def close(self):
+        if self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
@@ -9,7 +9,7 @@ import time
 
 
 import RunSM
-from BSP import Signal
+from BSP import Signal, state
 from Payload import Payload
 
 logger = logging.getLogger(__name__)
@@ -72,7 +72,7 @@ class Instrument(asyncio.Protocol):
         logger.addHandler(ch)
 
     def sendCallback(self, payload):
-        sig = Signal(self, verb='TCPCALLBACK', payload = payload)
+        sig = Signal.acquire(self, verb='TCPCALLBACK', payload = payload)
         self.runsm.registerSignal(sig)
 
 
@@ -182,13 +182,13 @@ class Instrument(asyncio.Protocol):
         for cmd in cmds :
             if "=" in cmd:
                 tokens = cmd.split('=')
-                sig = Signal(self, verb=tokens[0], payload=tokens[1])
+                sig = Signal.acquire(self, verb=tokens[0], payload=tokens[1])
             else:
-                sig = Signal(self, verb=cmd, payload="")
+                sig = Signal.acquire(self, verb=cmd, payload="")
             self.runsm.registerSignal(sig)
 
 
-    # INSTRU:SETSETRADUMPGAIN
+    @state("INSTRU", "SETSETRADUMPGAIN")
     def sm_setSetraDumpGain(self, payload):
 
         value = '0.80'
@@ -202,16 +202,16 @@ class Instrument(asyncio.Protocol):
         try:
             self.setradumpgain = float(value)
             self.sendCallback("Setra Dumpgain was set to " + value)
-            sig = Signal(self, verb='SENDACK', payload='SETRADUMPGAIN='+value)
+            sig = Signal.acquire(self, verb='SENDACK', payload='SETRADUMPGAIN='+value)
             self.runsm.registerSignal(sig)
         except Exception as e :
             self.sendCallback("Can't convert parameter due: {}".format(e.__repr__()))
-            sig = Signal(self, verb='SENDACK', payload='SETRADUMPGAIN=ERROR')
+            sig = Signal.acquire(self, verb='SENDACK', payload='SETRADUMPGAIN=ERROR')
             self.runsm.registerSignal(sig)
 
 
 
-    # INSTRU:SETSETRADUMPTHRS
+    @state("INSTRU", "SETSETRADUMPTHRS")
     def sm_setSetraDumpThrs(self, payload):
 
         value = payload[0]
@@ -221,14 +221,14 @@ class Instrument(asyncio.Protocol):
         try:
             self.setradumpthrs = float(value)
             self.sendCallback("Setra Dumpthreshold was set to " + value)
-            sig = Signal(self, verb='SENDACK', payload='SETRADUMPTHRS='+value)
+            sig = Signal.acquire(self, verb='SENDACK', payload='SETRADUMPTHRS='+value)
             self.runsm.registerSignal(sig)
         except Exception as e :
             self.sendCallback("Can't convert parameter due: {}".format(e.__repr__()))
-            sig = Signal(self, verb='SENDACK', payload='SETRADUMPTHRS=ERROR')
+            sig = Signal.acquire(self, verb='SENDACK', payload='SETRADUMPTHRS=ERROR')
             self.runsm.registerSignal(sig)
 
-    # INSTRU:SETVALVES
+    @state("INSTRU", "SETVALVES")
     def sm_setValves(self, payload):
 
         ack = 'INVALID'
@@ -243,11 +243,11 @@ class Instrument(asyncio.Protocol):
         else:
             logger.info(f'Setvalves(other)')
 
-        sig = Signal(self, verb='SENDACK', payload=ack)
+        sig = Signal.acquire(self, verb='SENDACK', payload=ack)
         self.runsm.registerSignal(sig)
 
 
-    # INSTRU:SETINSTRU
+    @state("INSTRU", "SETINSTRU")
     def sm_setInstru(self, payload):
 
         lockflag = self.setralock
@@ -284,16 +284,16 @@ class Instrument(asyncio.Protocol):
         self.setralock = lockflag
 
 
-    # INSTRU:BEACONLOCK
+    @state("INSTRU", "BEACONLOCK")
     def sm_beaconLock(self, payload):
 
         if "ON" in payload :
-            sig = Signal(self, verb="STARTBC", payload="")
+            sig = Signal.acquire(self, verb="STARTBC", payload="")
             self.runsm.registerSignal(sig)
             # self.sendCallback('Beacon is locked')
             return
         elif "OFF" in payload:
-            sig = Signal(self, verb="STOPBC", payload="")
+            sig = Signal.acquire(self, verb="STOPBC", payload="")
             self.runsm.registerSignal(sig)
             # self.sendCallback('Beacon is running')
             return
@@ -301,7 +301,7 @@ class Instrument(asyncio.Protocol):
             self.sendCallback('Beacon Lock mode must be "ON" or "OFF"')
 
 
-    # INSTRU:SENSORSLOCK
+    @state("INSTRU", "SENSORSLOCK")
     def sm_sensorsLock(self, payload):
 
         if "ON" in payload :
@@ -316,7 +316,7 @@ class Instrument(asyncio.Protocol):
             self.sendCallback('Lock mode must be "ON or "OFF')
 
 
-    # INSTRU:RESTARTINSTRU
+    @state("INSTRU", "RESTARTINSTRU")
     def sm_restartInstru(self, payload):
 
         self.sm_stopInstru("")
@@ -325,26 +325,25 @@ class Instrument(asyncio.Protocol):
         self.cmds_queue = Queue(128)
         self.cmdbuf = bytes()
 
-        loop = self.runsm.getEventLoop()
         self.setralock = False
         self.setraup = False
         self.setra = self.setrap
         self.setraspeed = 1
         self.setracnt = 1
-        self.instrutask = loop.create_task(self.ILoop())
+        self.instrutask = self.runsm.bridge.createTask(self.ILoop())
 
         self.setradumpgain = 0.88
 
-        sig = Signal(self, verb='SENDACK', payload='RESTARTINSTRU')
+        sig = Signal.acquire(self, verb='SENDACK', payload='RESTARTINSTRU')
         self.runsm.registerSignal(sig)
 
         self.sendCallback('Instrument task was enabled - Sensors unlocked - Beacon is inactive')
         self.sendCallback(f'Dumping Threshold is {self.setradumpthrs}')
 
-    # INSTRU:STOPINSTRU
+    @state("INSTRU", "STOPINSTRU")
     def sm_stopInstru(self, payload):
         if self.instrutask is not None :
-            sig = Signal(self, verb="STOPBC", payload="")
+            sig = Signal.acquire(self, verb="STOPBC", payload="")
             self.runsm.registerSignal(sig)
             self.instrutask.cancel()
             self.instrutask = None
@@ -0,0 +1,152 @@
+import argparse
+import asyncio
+import logging
+import random
+import time
+
+# Console load generator : N concurrent sessions each send commands picked from a weighted mix
+# and wait for the prompt that follows the answer. Latency is the time from the command line
+# written to the first prompt read back. Commands that stay silent (STOPBC with no beacon
+# running ...) are counted as unanswered once timeout expires.
+
+PROMPT = b'opus@virna5:'
+DEFAULT_MIX = 'SENDTICK:5,SETINSTRU UP:1,SETINSTRU DOWN:1,STARTBC:1,STOPBC:1'
+
+
+def parseMix(text) -> list:
+    # "VERB args:weight,..." -> [(command, weight), ...]
+    mix = list()
+    for item in text.split(','):
+        command, _, weight = item.rpartition(':')
+        if not command:
+            command, weight = weight, '1'
+        mix.append((command.strip().upper(), int(weight)))
+    return mix
+
+
+async def connect(target):
+    kind, _, address = target.partition(':')
+    if kind == 'unix':
+        return await asyncio.open_unix_connection(address)
+    host, _, port = address.rpartition(':')
+    return await asyncio.open_connection(host.strip('[]'), int(port))
+
+
+class LoadGen:
+
+    def __init__(self, target, sessions=10, commands=200, mix=DEFAULT_MIX, timeout=2.0, seed=0):
+        self.target = target
+        self.sessions = sessions
+        self.commands = commands
+        self.mix = parseMix(mix)
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+
+        self.latencies = list()
+        self.unanswered = 0
+        self.per_verb = dict()
+
+
+    async def session(self, n):
+        reader, writer = await connect(self.target)
+        # Welcome banner, and whatever the first session gets from the instrument restart
+        await reader.readuntil(PROMPT)
+        await asyncio.sleep(0.5)
+        while True:
+            try:
+                await asyncio.wait_for(reader.readuntil(PROMPT), 0.05)
+            except asyncio.TimeoutError:
+                break
+
+        commands, weights = zip(*self.mix)
+        picks = self.rng.choices(commands, weights, k=self.commands)
+        await self.start.wait()
+
+        for command in picks:
+            t0 = time.perf_counter()
+            writer.write(bytes(command, 'utf8') + b'\r\n')
+            try:
+                await asyncio.wait_for(reader.readuntil(PROMPT), self.timeout)
+            except asyncio.TimeoutError:
+                self.unanswered += 1
+                continue
+            elapsed = time.perf_counter() - t0
+            self.latencies.append(elapsed)
+            verb = command.split()[0]
+            self.per_verb[verb] = self.per_verb.get(verb, 0) + 1
+
+        writer.close()
+
+
+    async def run(self) -> dict:
+        self.start = asyncio.Event()
+        tasks = [asyncio.ensure_future(self.session(n)) for n in range(self.sessions)]
+        # Let every session connect and settle before the clock starts
+        await asyncio.sleep(0.8)
+        t0 = time.perf_counter()
+        self.start.set()
+        await asyncio.gather(*tasks)
+        wall = time.perf_counter() - t0
+
+        samples = sorted(self.latencies)
+        n = len(samples)
+        pick = lambda p: samples[min(n - 1, int(n * p / 100))] * 1000 if n else 0.0
+        return {
+            'sessions'      : self.sessions,
+            'commands'      : self.sessions * self.commands,
+            'answered'      : n,
+            'unanswered'    : self.unanswered,
+            'wall_s'        : wall,
+            'commands_per_s': n / wall if wall > 0 else 0.0,
+            'p50_ms'        : pick(50),
+            'p99_ms'        : pick(99),
+            'p999_ms'       : pick(99.9),
+            'max_ms'        : samples[-1] * 1000 if n else 0.0,
+            'per_verb'      : self.per_verb,
+        }
+
+
+async def stubServer(dispatch):
+    # In process server on stub serial / console transports, for machines without the device.
+    # Returns the RunSM, to be stopped once done, and the target to connect to
+    from Stubs import buildStubStack
+    from BSP import DISPATCH
+
+    sm = buildStubStack(getattr(DISPATCH, dispatch.upper()))
+    for name in ('RunSM', 'PSerial', 'TCPServer', 'Instrument'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    # Drop the stub console so the first generated session restarts the instrument, as an operator would
+    sm.unregisterSession(sm.sessions[1])
+
+    loop = asyncio.get_event_loop()
+    sm.go(loop)
+    server = await sm.tcpserver.listen(loop, 'tcp:127.0.0.1:0')
+    return sm, 'tcp:127.0.0.1:{}'.format(server.sockets[0].getsockname()[1])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Console load generator')
+    parser.add_argument('--target', default='tcp:127.0.0.1:8888', help='tcp:host:port or unix:path')
+    parser.add_argument('--stub', action='store_true',
+                        help='start an in process server on stub transports instead of using --target')
+    parser.add_argument('--dispatch', choices=['thread', 'async', 'realms'], default='async',
+                        help='RunSM dispatcher of the --stub server')
+    parser.add_argument('-c', '--sessions', type=int, default=10, help='concurrent sessions')
+    parser.add_argument('-n', '--commands', type=int, default=200, help='commands per session')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='weighted commands, "VERB args:weight,..."')
+    parser.add_argument('--timeout', type=float, default=2.0, help='seconds to wait for a prompt')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    sm, target = loop.run_until_complete(stubServer(args.dispatch)) if args.stub else (None, args.target)
+
+    gen = LoadGen(target, args.sessions, args.commands, args.mix, args.timeout, args.seed)
+    report = loop.run_until_complete(gen.run())
+    if sm is not None:
+        # The thread dispatcher is not a daemon : the process would not exit with it running
+        sm.runsm_dispatcher_quit()
+    for key, value in report.items():
+        print('{:<15} {}'.format(key, round(value, 3) if isinstance(value, float) else value))
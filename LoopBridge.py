@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# Pending operation kinds
+WRITE, CALL = range(2)
+
+
+class LoopBridge:
+
+    # Marshals transport writes and loop work issued by state handlers onto the asyncio loop.
+    # Everything a handler issues during one state step is gathered in a thread local list and
+    # handed to the loop as a single callback, consecutive writes to a transport being joined.
+
+    def __init__(self):
+        self.loop:asyncio.AbstractEventLoop = None
+        self.loop_thread = None
+        self.local = threading.local()
+
+        # Shown by STATS : handler steps, writes issued, loop callbacks used to carry them
+        self.steps = 0
+        self.writes = 0
+        self.flushes = 0
+
+
+    def bind(self, loop):
+        # Must be called from the thread that runs the loop
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+
+    def counters(self) -> dict:
+        return {'steps': self.steps, 'writes': self.writes, 'flushes': self.flushes}
+
+    def resetCounters(self):
+        self.steps = 0
+        self.writes = 0
+        self.flushes = 0
+
+    def inLoop(self) -> bool:
+        return self.loop is None or threading.get_ident() == self.loop_thread
+
+
+    def beginStep(self):
+        self.local.pending = []
+
+    def endStep(self):
+        pending = self.local.pending
+        self.local.pending = None
+        self.steps += 1
+        if pending:
+            self.flushes += 1
+            if self.inLoop():
+                self.runPending(pending)
+            else:
+                self.loop.call_soon_threadsafe(self.runPending, pending)
+
+
+    def inStep(self) -> bool:
+        # True while a state handler runs on this thread
+        return getattr(self.local, 'pending', None) is not None
+
+
+    def write(self, transport, data):
+        self.writes += 1
+        pending = getattr(self.local, 'pending', None)
+        if pending is None:
+            if self.inLoop():
+                transport.write(data)
+            else:
+                self.loop.call_soon_threadsafe(transport.write, data)
+        elif pending and pending[-1][0] == WRITE and pending[-1][1] is transport:
+            pending[-1][2].append(data)
+        else:
+            pending.append((WRITE, transport, [data]))
+
+    def call(self, func, *args):
+        pending = getattr(self.local, 'pending', None)
+        if pending is None:
+            if self.inLoop():
+                func(*args)
+            else:
+                self.loop.call_soon_threadsafe(func, *args)
+        else:
+            pending.append((CALL, func, args))
+
+    def createTask(self, coro):
+        # Returns an asyncio Task on the loop thread, or a concurrent Future whose cancel()
+        # is safe to call from any thread
+        if self.inLoop():
+            return self.loop.create_task(coro)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+    def runPending(self, pending):
+        for kind, target, args in pending:
+            try:
+                if kind == WRITE:
+                    target.write(args[0] if len(args) == 1 else b''.join(args))
+                else:
+                    target(*args)
+            except Exception as e:
+                logger.info("Bridge failed to run {} due: {}".format(target, e.__repr__()))
@@ -0,0 +1,123 @@
+import json
+import logging
+
+from BSP import Signal
+from TCPServer import TCPSession
+
+logger = logging.getLogger(__name__)
+
+
+# One JSON object per line in both directions.
+#   request  {"id": 7, "cmd": "SENDTICK 1"}   or   {"id": 7, "verb": "SENDTICK", "args": ["1"]}
+#   records  {"id": 7, "type": "ack", "verb": "SENDTICK", "depth": 1}      signal admitted
+#            {"id": 7, "type": "error", "error": "..."}                    request refused
+#            {"id": 7, "type": "reply", "text": "TICK was sent..."}       output of the request
+#            {"type": "event", "text": "..."}                              beacon / instrument output
+#            {"type": "telemetry", "t": 1.5, "values": {"SETRA": 64000}}    SUBSCRIBE stream
+#            {"type": "hello", "sid": 2, "version": "5.0"}                 on connection
+# ids are echoed back as given, requests without one get "id": null
+
+VERSION = '5.0'
+
+
+def encodeRecord(record) -> str:
+    return json.dumps(record, separators=(',', ':')) + '\n'
+
+def cleanText(data) -> str:
+    # Console frames use \n\r line ends
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf8', 'replace')
+    return data.replace('\r', '').strip('\n')
+
+
+class MachineRequest:
+
+    # Origin of the signals of one machine request : replies carry its correlation id
+
+    __slots__ = ('session', 'id')
+
+    def __init__(self, session, rid):
+        self.session = session
+        self.id = rid
+
+    @property
+    def history(self):
+        return self.session.history
+
+    def reply(self, data, prompt=True):
+        self.session.sendRecord({'id': self.id, 'type': 'reply', 'text': cleanText(data)})
+
+
+class MachineSession(TCPSession):
+
+    # Machine protocol connection : same verbs, line framing and session registry as the
+    # console, no prompt, no echo, no ANSI. Create with functools.partial(MachineSession, tcps)
+
+    def greet(self):
+        self.sendRecord({'type': 'hello', 'sid': self.sid, 'version': VERSION})
+
+    @staticmethod
+    def encodeEvent(data) -> bytes:
+        return bytes(encodeRecord({'type': 'event', 'text': cleanText(data)}), 'utf8')
+
+    @staticmethod
+    def encodeTelemetry(t, channels, values) -> bytes:
+        return bytes(encodeRecord({'type': 'telemetry', 't': round(t, 3), 'values': dict(zip(channels, values))}), 'utf8')
+
+
+    def lineReceived(self, line):
+
+        if not line.strip():
+            return
+
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            self.sendError(None, 'bad request : {}'.format(e))
+            return
+        if not isinstance(request, dict):
+            self.sendError(None, 'bad request : not an object')
+            return
+
+        rid = request.get('id')
+        if 'cmd' in request:
+            tokens = str(request['cmd']).upper().split()
+        else:
+            tokens = [str(request.get('verb', ''))] + [str(arg) for arg in request.get('args', ())]
+            tokens = [token.upper() for token in tokens if token]
+
+        if not tokens or not self.runsm.hasState(tokens[0]):
+            self.sendError(rid, 'unknown verb {}'.format(tokens[0] if tokens else ''))
+            return
+
+        sig = Signal.acquire(self, verb=tokens[0], payload = tokens)
+        sig.origin = MachineRequest(self, rid)
+        verb = tokens[0]
+        depth = self.runsm.registerSignal(sig)
+        if depth < 0:
+            self.sendError(rid, 'rejected {} : signal queue full'.format(verb))
+        else:
+            self.sendRecord({'id': rid, 'type': 'ack', 'verb': verb, 'depth': depth})
+
+
+    def send(self, data, prompt=True):
+        # Never a console prompt in the record stream, whatever the caller asks (broadcasts ...)
+        super().send(data, prompt=False)
+
+    def sendRecord(self, record):
+        # Loop thread only
+        self.send(encodeRecord(record), prompt=False)
+
+    def sendError(self, rid, error):
+        self.sendRecord({'id': rid, 'type': 'error', 'error': error})
+
+    def reply(self, data, prompt=True):
+        # The session itself is the origin (RESTARTINSTRU on connection ...)
+        self.sendRecord({'id': None, 'type': 'reply', 'text': cleanText(data)})
+
+    def showText(self, text):
+        # Session level notices (line too long ...)
+        self.sendRecord({'type': 'event', 'text': cleanText(text)})
+
+    def showHistory(self):
+        pass
@@ -1,22 +1,29 @@
 import asyncio
+import bisect
 import logging
 import math
 from asyncio import Task
 from queue import SimpleQueue
 
-import numpy as np
-
 import serial_asyncio
 import time
 
 import RunSM
-from BSP import Signal
+from BSP import Signal, state
 import Instrument
 from Payload import Payload
+from Stats import TickStats
+from Util import findFile
+from Waveform import WaveformLibrary
 
 logger = logging.getLogger(__name__)
 
 
+def wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
 
 class PSerial(asyncio.Protocol):
 
@@ -30,16 +37,28 @@ class PSerial(asyncio.Protocol):
         self.beacon_tick = 0.25
         self.beacon_singlerun = True
         self.beacon_queue = SimpleQueue()
+        # Falling behind by more than a period : SKIP the missed ticks, or CATCHUP by sending them
+        # back to back (at most beacon_catchup_max, older ones are skipped)
+        self.beacon_policy = 'SKIP'
+        self.beacon_catchup_max = 8
+        self.beacon_stats = TickStats('BEACON', 'SERIAL')
+
+        # SENDBLOCK : 115200 baud 8N1 is 11520 bytes/s, paced in slots of block_slot seconds
+        self.block_task:Task = None
+        self.block_seq = 0
+        self.block_bps = 11520
+        self.block_slot = 0.01
 
         self.payload = Payload()
 
         # self.x1 = list(range(-20, 21))
         # self.y1 = [(xx**2)+200 for xx in self.x]
 
-        x2 = np.arange(0, 1, 0.025)
-        self.y2 = (np.sin(2*np.pi*x2)+2)*10000
-        self.y3 = self.y2.astype(int)
-        self.bflen = len(self.y3)-2
+        # SENDBLOCK samples : the waveform selected with WAVE, a 40 points sine by default
+        self.waves = WaveformLibrary()
+        self.wave_kind = 'SINE'
+        self.wave_params = dict()
+        self.wave_dir = 'waves'
 
         self.configLogger(qlog)
 
@@ -62,7 +81,7 @@ class PSerial(asyncio.Protocol):
         # print ('data to send : ', data)
         if isinstance(data, str):
             data = bytes(data, 'utf8')
-        self.transport.write(data)
+        self.runsm.bridge.write(self.transport, data)
 
 
     def data_received(self, data):
@@ -97,8 +116,18 @@ class PSerial(asyncio.Protocol):
 
 
     async def SerialGate(self):
+        # Ticks fire on absolute loop.time() deadlines, so encode / write time and loop lag
+        # do not stretch the period and the rate seen by the instrument does not drift
+        loop = asyncio.get_running_loop()
+        stats = self.beacon_stats
+        deadline = loop.time()
 
         while True :
+            now = loop.time()
+            stats.tick(now, deadline)
+            if self.beacon_policy == 'CATCHUP' and now - deadline >= self.beacon_tick:
+                stats.caught_up += 1
+
             pload = ''
             if not self.beacon_queue.empty() :
                 pload = self.beacon_queue.get()
@@ -107,32 +136,47 @@ class PSerial(asyncio.Protocol):
             s = self.payload.getBytes(None, self.instrument.setra, pload)
             self.sendRawData(s)
 
-            await asyncio.sleep(self.beacon_tick)
-
-
-    def sendCallback(self, payload):
-        sig = Signal(self, verb='TCPCALLBACK', payload = payload)
+            deadline += self.beacon_tick
+            now = loop.time()
+            if deadline <= now:
+                behind = int((now - deadline) // self.beacon_tick) + 1
+                skipped = behind if self.beacon_policy == 'SKIP' else max(0, behind - self.beacon_catchup_max)
+                stats.missed += skipped
+                deadline += skipped * self.beacon_tick
+
+            waiter = loop.create_future()
+            handle = loop.call_at(deadline, wake, waiter)
+            try:
+                await waiter
+            finally:
+                handle.cancel()
+
+
+    def sendCallback(self, payload, origin=None):
+        # origin : who the text answers, for tasks running outside a state step
+        sig = Signal.acquire(self, verb='TCPCALLBACK', payload = payload)
+        sig.origin = origin
         self.runsm.registerSignal(sig)
 
 
     # STATES ===========================================================================================================
 
-    # SERIAL:SERIALINIT
+    @state("SERIAL", "SERIALINIT")
     def sm_init(self, payload):
         logger.debug("Em Init State")
 
-    # SERIAL:SERIALCONFIG
+    @state("SERIAL", "SERIALCONFIG")
     def sm_config(self, payload):
         logger.debug("Serial config called")
         self.sendRawData(payload)
 
-    # SERIAL:SERIALWRITE
+    @state("SERIAL", "SERIALWRITE")
     def sm_swrite(self, payload):
         logger.info("Serial write called")
         self.sendRawData(payload)
 
     # ================================================= APP Interface
-    # SERIAL:STARTBC
+    @state("SERIAL", "STARTBC")
     def sm_enableBeacon(self, payload):
 
         if self.beacon_task is None:
@@ -140,14 +184,16 @@ class PSerial(asyncio.Protocol):
             # s = self.payload.getBytes(None, -1, 'RESETMEAS')
             # self.sendRawData(s)
 
-            loop = self.runsm.getEventLoop()
-            self.beacon_task = loop.create_task(self.SerialGate())
+            self.beacon_stats.reset()
+            self.beacon_task = self.runsm.bridge.createTask(self.SerialGate())
 
             self.sm_sendACK("STARTBC")
             self.sendCallback('Beacon was enabled.')
+        else:
+            self.sendCallback('Beacon is already enabled.')
 
 
-    # SERIAL:STOPBC
+    @state("SERIAL", "STOPBC")
     def sm_disableBeacon(self, payload):
         if self.beacon_task is not None :
             self.beacon_task.cancel()
@@ -158,10 +204,12 @@ class PSerial(asyncio.Protocol):
             self.sm_sendACK("STOPBC")
 
             self.sendCallback('Beacon was stopped.')
+        else:
+            self.sendCallback('Beacon is not running.')
 
 
 
-    # SERIAL:SENDACK
+    @state("SERIAL", "SENDACK")
     def sm_sendACK(self, payload):
         sout = "AUTOACKCALLBACK="+payload
 
@@ -178,35 +226,124 @@ class PSerial(asyncio.Protocol):
 
     # ======================================= Serial Beacon Internal tests
 
-    # SERIAL:SENDBLOCK
+    @state("SERIAL", "SENDBLOCK")
     def sm_sendBlock(self, payload : list):
-
-        # if self.beacon_task is not None :
-            #  First send command do reset measurements buffers
-            self.beacon_queue.put(self.payload.getBytes(None, -1, 'RESETMEAS'))
-
-            #  Now send the package
-            if len(payload) == 2 :
-                try :
-                    ticknum = int(payload[1])
-                except Exception as e:
-                    self.sendCallback("Can't convert parameter due: {}".format(e.__repr__()))
-                    return
-                pkg = self.y3[:ticknum]
+        # SENDBLOCK [ticks] [BPS n | FPS n] : RESETMEAS, one tick frame per sample, ENDMEAS, encoded
+        # into one buffer and streamed at the line rate (or the given byte / frame rate)
+        # SENDBLOCK STOP                    : abort the block in progress
+        tokens = payload[1:] if isinstance(payload, list) else []
+
+        if 'STOP' in tokens:
+            if self.block_task is not None:
+                self.block_task.cancel()
+                self.block_task = None
+                self.sendCallback('Block was stopped')
             else:
-                pkg = self.y3
-
-            for data in pkg :
-                pload = self.payload.getBytes(None, data)
-                self.beacon_queue.put(pload)
-
-            self.beacon_queue.put(self.payload.getBytes(None, -1, 'ENDMEAS'))
-            self.sendCallback("Block Sent ...")
-        # else:
-        #     self.sendCallback("Can't do it -> Beacon is not enabled")
-
-
-    # SERIAL:BCTICK
+                self.sendCallback('No block in progress')
+            return
+        if self.block_task is not None:
+            self.sendCallback("Can't do it -> a block is in progress")
+            return
+
+        try :
+            wave = self.waves.table(self.wave_kind, **self.wave_params)
+            pkg = wave[:int(tokens[0])] if tokens and tokens[0].isdigit() else wave
+            unit, rate = 'BPS', self.block_bps
+            for name in ('BPS', 'FPS'):
+                if name in tokens:
+                    unit, rate = name, float(tokens[tokens.index(name) + 1])
+            if rate <= 0:
+                raise ValueError('rate must be positive')
+        except Exception as e:
+            self.sendCallback("Can't convert parameter due: {}".format(e.__repr__()))
+            return
+
+        frames = [self.payload.getBytes(None, -1, 'RESETMEAS'),
+                  self.payload.getTicksBytes(pkg),
+                  self.payload.getBytes(None, -1, 'ENDMEAS')]
+
+        # Frame ends : the tick frames all have the same size
+        size = self.payload.tick_dtype.itemsize
+        ends = [len(frames[0])]
+        ends.extend(range(ends[0] + size, ends[0] + len(frames[1]) + 1, size))
+        ends.append(ends[-1] + len(frames[2]))
+        marks = ends if unit == 'BPS' else list(range(1, len(ends) + 1))
+        self.block_seq += 1
+        gate = self.BlockGate(b''.join(frames), ends, marks, rate, self.block_seq, self.runsm.currentOrigin())
+        self.block_task = self.runsm.bridge.createTask(gate)
+        self.sendCallback('Block of {} frames, {} bytes, streaming at {:g} {}'.format(
+                            len(ends), ends[-1], rate, unit))
+
+
+    async def BlockGate(self, data, ends, marks, rate, seq, origin=None):
+        # Paces one pre-encoded block : each slot writes the whole frames the rate allows by the end
+        # of the slot, then waits for the absolute time those units take at the rate
+        loop = asyncio.get_running_loop()
+        view = memoryview(data)
+        t0 = loop.time()
+        sent = 0
+        done = 0
+
+        try :
+            while done < len(ends):
+                allowed = (loop.time() - t0 + self.block_slot) * rate
+                upto = max(bisect.bisect_right(marks, allowed, done), done + 1)
+                self.sendRawData(view[sent:ends[upto - 1]])
+                sent = ends[upto - 1]
+                done = upto
+
+                waiter = loop.create_future()
+                handle = loop.call_at(t0 + marks[done - 1] / rate, wake, waiter)
+                try:
+                    await waiter
+                finally:
+                    handle.cancel()
+        finally:
+            # A stopped block ends after the next one may have started : leave that one's task alone
+            if self.block_seq == seq:
+                self.block_task = None
+
+        elapsed = loop.time() - t0
+        self.sendCallback('Block sent : {} frames, {} bytes in {:.1f} ms ({:.0f} frames/s, {:.0f} B/s)'.format(
+                            done, sent, elapsed * 1000, done / elapsed, sent / elapsed), origin)
+
+
+    @state("SERIAL", "WAVE")
+    def sm_wave(self, payload):
+        # WAVE                                   -> current waveform and table cache
+        # WAVE SINE|RAMP|STEP|PUMPDOWN|BUILDUP [NAME=value ...]
+        # WAVE FILE <name> [N=points] [...]      -> recording from wave_dir, resampled to N points if given
+        tokens = payload[1:] if isinstance(payload, list) else []
+        kind, params = self.wave_kind, self.wave_params
+
+        try :
+            if tokens:
+                kind, params, rest = tokens[0], dict(), tokens[1:]
+                if kind == 'FILE':
+                    if not rest:
+                        raise ValueError('WAVE FILE needs a file name')
+                    params['path'] = findFile(self.wave_dir, rest[0], 'recording')
+                    rest = rest[1:]
+                for token in rest:
+                    name, _, value = token.partition('=')
+                    params[name.lower()] = value
+            t0 = time.perf_counter()
+            wave = self.waves.table(kind, **params)
+            elapsed = time.perf_counter() - t0
+        except Exception as e:
+            self.sendCallback("Can't set waveform due: {}".format(e.__repr__()))
+            return
+
+        self.wave_kind, self.wave_params = kind, params
+        settings = self.waves.params(kind, **params)
+        self.sendCallback('Waveform {} {} : {} samples, min {} max {}, table ready in {:.1f} us\n\r{}'.format(
+                            kind, ' '.join('{}={:g}'.format(k, v) if k != 'path' else 'path=' + v
+                                           for k, v in settings.items()),
+                            len(wave), wave.min() if len(wave) else 0, wave.max() if len(wave) else 0,
+                            elapsed * 1e6, self.waves.describe()))
+
+
+    @state("SERIAL", "BCTICK")
     def sm_setBeaconTick(self, payload):
 
         if self.beacon_task is not None :
@@ -215,13 +352,33 @@ class PSerial(asyncio.Protocol):
             except Exception as e :
                 self.sendCallback("Can't convert parameter due: {}".format(e.__repr__()))
                 return
+            if not btick > 0:
+                # The beacon clock divides by the tick and would spin on a negative one
+                self.sendCallback('Beacon tick must be a positive number of seconds, got {}'.format(payload[1]))
+                return
             self.beacon_tick = btick
             self.sendCallback('Beacon tick was set to {}'.format(btick))
         else:
             self.sendCallback("Can't do it -> Beacon is not enabled")
 
 
-    # SERIAL:SENDBEACON
+    @state("SERIAL", "BCSTATS")
+    def sm_beaconStats(self, payload):
+        # BCSTATS [RESET | SKIP | CATCHUP] : beacon rate, lateness and missed ticks, or set the late policy
+        tokens = payload[1:] if isinstance(payload, list) else []
+        if 'RESET' in tokens:
+            self.beacon_stats.reset()
+            self.sendCallback('Beacon stats cleared')
+        elif 'SKIP' in tokens or 'CATCHUP' in tokens:
+            self.beacon_policy = 'SKIP' if 'SKIP' in tokens else 'CATCHUP'
+            self.sendCallback('Beacon late policy is {}'.format(self.beacon_policy))
+        else:
+            running = 'running' if self.beacon_task is not None else 'stopped'
+            self.sendCallback('Beacon is {}, late policy {}\n\r'.format(running, self.beacon_policy) +
+                              self.beacon_stats.report(self.beacon_tick))
+
+
+    @state("SERIAL", "SENDBEACON")
     def sm_sendBeacon(self, payload):
 
         s = self.payload.getBytes()
@@ -230,7 +387,7 @@ class PSerial(asyncio.Protocol):
         self.sendCallback("Beacon was sent...")
 
 
-    # SERIAL:SENDTICK
+    @state("SERIAL", "SENDTICK")
     def sm_sendTick(self, sm_payload : list):
 
         if len(sm_payload) == 1 :
@@ -4,6 +4,8 @@ from array import array
 from collections import namedtuple
 import time
 
+import numpy as np
+
 class Payload (object):
 
 
@@ -32,6 +34,9 @@ class Payload (object):
             }
 
     # TICK CONFIG
+    # ff fa | tick (native int64) | cmd bytes | 00 | ff f0 , 13 bytes with no command
+    tick_dtype = np.dtype([('sof', 'u1', (2,)), ('tick', '=i8'), ('cmd', 'u1'), ('eof', 'u1', (2,))])
+    tick_structs = dict()
 
     def initBeacon(self):
 
@@ -85,6 +90,34 @@ class Payload (object):
 
 
 
+    def getTicksBytes(self, ticks, cmds=None) -> bytes:
+        # All tick frames of ticks (and of the matching cmds strings, if given) in one buffer,
+        # byte identical to joining getBytes(None, tick, cmd) for each of them
+
+        if cmds is None or not any(cmds):
+            frames = np.zeros(len(ticks), dtype=self.tick_dtype)
+            frames['sof'] = (0xff, 0xfa)
+            frames['tick'] = ticks
+            frames['eof'] = (0xff, 0xf0)
+            return frames.tobytes()
+
+        # As getBytes, the command field is sized on the string length (not its utf8 length)
+        cmds = [cmd or '' for cmd in cmds]
+        out = bytearray(13 * len(cmds) + sum(len(cmd) for cmd in cmds))
+        pos = 0
+        for tick, cmd in zip(ticks, cmds):
+            frame = self.tickStruct(len(cmd))
+            frame.pack_into(out, pos, b'\xff\xfa', int(tick), bytes(cmd, 'utf8'), b'\xff\xf0')
+            pos += frame.size
+        return bytes(out)
+
+    def tickStruct(self, ldata) -> Struct:
+        frame = self.tick_structs.get(ldata)
+        if frame is None:
+            frame = self.tick_structs[ldata] = Struct('=2sq{}sx2s'.format(ldata))
+        return frame
+
+
     def setSensor (self, name='setra', value=-1):
         self.xducers[name] = value
         pack_into( '40s', self.beacon_payload, self.ofs_xducers,
@@ -1,49 +1,75 @@
 import asyncio
 import inspect
-import logging, re
+import logging
 import os
 import time
-from threading import Thread, Timer
+import threading
+from threading import Thread
 # from pydispatch import dispatcher
-from queue import Queue
 # from itertools import izip
 
-from BSP import SMStates, SIGNALS, ENTITIES, Signal
+from BSP import SMStates, SIGNALS, ENTITIES, DISPATCH, Signal, SignalQueue, STATES_REGISTRY, state
 
 import Instrument
+from LoopBridge import LoopBridge
 from PSerial import PSerial
+from Script import ScriptCache
+from Stats import RunStats
+from Telemetry import Telemetry
+from Trace import TraceRecorder
+from TimerService import TimerService
 from TCPServer import TCPServer
+from Util import findFile
 
 logger = logging.getLogger(__name__)
 
 
 class RunSM:
 
-    def __init__(self, qlog, ps, tcps, instru):
+    def __init__(self, qlog, ps, tcps, instru, dispatch=DISPATCH.THREAD, batch_cap=32, queue_size=1024):
 
         self.configLogger(qlog)
 
 
         self.__running = True
+        self.dispatch = dispatch
 
         self.pserial:PSerial = ps
         self.tcpserver:TCPServer = tcps
         self.instrument:Instrument = instru
 
         self.eventloop:asyncio.EventLoop
-
-        self.timerflag = False
-        self.timer_reload = 0
-        self.timer_counter = 0
+        self.bridge = LoopBridge()
+        self._wakeup:asyncio.Event = None
+
+        self.timers = TimerService()
+        self.script_dir = 'scripts'
+        self.stats = RunStats()
+        self.telemetry = Telemetry(self)
+        self.recorder:TraceRecorder = None
+        self.trace_dir = 'traces'
+        self.service_realms = dict()
+
+        # Console sessions by id, and the session the running state answers to (per thread)
+        self.sessions = dict()
+        self.session_seq = 0
+        self._ctx = threading.local()
 
         self.smstates = SMStates()
         self._states_stack1 = list()
-        self.signal_queue = Queue()
+        self.queue_size = queue_size
+        self.signal_queue = SignalQueue(maxsize=queue_size)
+        self.batch_cap = batch_cap
+        self.workers = dict()
+        self._dispatch_threads = set()
 
         self.registerStates(self)
         self.registerStates(self.pserial)
         self.registerStates(self.tcpserver)
         self.registerStates(self.instrument)
+        self.registerStates(self.telemetry)
+        self._idle = self.smstates.findState("IDLE")
+        self.scripts = ScriptCache(self.smstates)
 
         self.callState("IDLE")
         # self.callState("SERIALCONFIG", "Teste do Serial -  VINDO DO INIT\r\n")
@@ -55,6 +81,25 @@ class RunSM:
 
 
     def registerStates(self, service):
+        # O(n) load from the registry built by @state, no source access needed
+        entries = list()
+        for cls in type(service).__mro__:
+            entries.extend(STATES_REGISTRY.get(cls.__module__ + '.' + cls.__qualname__, ()))
+
+        if entries:
+            for mname, trealm, tstate in entries:
+                self.smstates.addState(tstate, 0, trealm, getattr(service, mname))
+        else:
+            self.registerStatesFromComments(service)
+
+        # The realm of its states names the service when it shows up as a signal caller
+        for tstate in self.smstates.states:
+            if getattr(tstate.func, '__self__', None) is service:
+                self.service_realms[id(service)] = tstate.realm
+                break
+
+    def registerStatesFromComments(self, service):
+        # Fallback for services whose sm_ methods are still tagged with "# REALM:STATE" comments
         members = inspect.getmembers(service)
         for member in members :
             if member[0].startswith('sm_'):
@@ -66,18 +111,121 @@ class RunSM:
                 self.smstates.addState(tstate, 0, trealm, func)
 
 
-    def callState (self, name, payload = None):
-        newstate = self.smstates.getNewState(name)
-        newstate.push_payload(payload)
-        self._states_stack1.append(newstate)
+    def callState (self, name, payload = None, origin = None):
+        # The stack holds (shared state descriptor, payload, origin) entries : no per call copy
+        tstate = self.smstates.byname.get(name)
+        if tstate is None:
+            logger.warning("Unknown state : {}".format(name))
+            return
+        self._states_stack1.append((tstate, payload, origin))
+
+    def loadStates(self, entries, origin = None):
+        # Queue (state, payload) pairs to run in the given order, whatever the dispatch mode
+        if origin is None:
+            origin = self.currentOrigin()
+        if self.workers:
+            if entries:
+                self.routeChain(entries, origin)
+        else:
+            self._states_stack1.extend((tstate, payload, origin) for tstate, payload in reversed(entries))
+
+    def routeChain(self, entries, origin):
+        # Realm dispatcher : route the first entry and the rest once it has run, so the order
+        # holds across realms. What a step raises is queued ahead of the steps that follow it
+        tstate, payload = entries[0]
+        signal = Signal(self, verb=tstate.sname, payload=payload)
+        signal.origin = origin
+        signal.then = entries[1:] or None
+        self.routeSignal(signal)
+
+    def currentOrigin(self):
+        return getattr(self._ctx, 'origin', None)
+
+    def registerSession(self, session):
+        self.session_seq += 1
+        session.sid = self.session_seq
+        self.sessions[session.sid] = session
+
+    def unregisterSession(self, session):
+        self.sessions.pop(session.sid, None)
+
+    def hasSession(self, origin):
+        # origin is a session, or a request made through one (machine protocol)
+        session = getattr(origin, 'session', origin)
+        return self.sessions.get(getattr(session, 'sid', 0)) is session
 
     def hasState(self, name):
         return self.smstates.findState(name)
 
 
-    def registerSignal(self, signal):
-        sig1 = Signal()
-        self.signal_queue.put(signal)
+    def registerSignal(self, signal) -> int:
+        # Queue depth once admitted (merged signals included), -1 if unknown or rejected
+        if self.recorder is not None:
+            self.recorder.record(self.callerRealm(signal.caller), signal.verb, signal.payload, self.bridge.inStep())
+
+        tstate = self.smstates.byname.get(signal.verb)
+        if tstate is None:
+            logger.warning("Unknown state : {}".format(signal.verb))
+            Signal.release(signal)
+            return -1
+        signal.op = tstate.op
+        signal.ts = time.perf_counter()
+        if signal.origin is None:
+            # Sessions answer for themselves, anything else inherits from the running state
+            signal.origin = signal.caller if hasattr(signal.caller, 'reply') else self.currentOrigin()
+
+        if self.workers:
+            depth = self.workers[tstate.realm].put(signal, self.canBlock())
+        else:
+            depth = self.signal_queue.put(signal, self.canBlock())
+            if self._wakeup is not None:
+                self.wakeUp()
+        if depth < 0:
+            Signal.release(signal)
+        return depth
+
+    def callerRealm(self, caller) -> str:
+        if caller is None:
+            return ''
+        return self.service_realms.get(id(caller), type(caller).__name__)
+
+    def canBlock(self):
+        # Backpressure must never stall the loop or the dispatcher that would drain the queue
+        return threading.get_ident() not in self._dispatch_threads and not self.bridge.inLoop()
+
+    def queueCounters(self) -> dict:
+        if not self.workers:
+            return self.signal_queue.counters()
+        # Event counters add up over the realm queues, maxsize is the bound of each one
+        total = dict()
+        for worker in self.workers.values():
+            for key, value in worker.queue.counters().items():
+                total[key] = value if key == 'maxsize' else total.get(key, 0) + value
+        return total
+
+    def queueLoad(self) -> float:
+        # Fill ratio of the fullest signal queue, 0 when unbounded
+        queues = [worker.queue for worker in self.workers.values()] if self.workers else [self.signal_queue]
+        return max([q.qsize() / q.maxsize for q in queues if q.maxsize] or [0.0])
+
+    def routeSignal(self, signal):
+        # Realm dispatcher : hand the signal to the worker owning the target state realm
+        tstate = self.smstates.byname.get(signal.verb)
+        if tstate is None:
+            logger.warning("Unknown state : {}".format(signal.verb))
+            return
+        signal.op = tstate.op
+        self.workers[tstate.realm].put(signal, self.canBlock())
+
+    def isRunning(self):
+        return self.__running
+
+    def wakeUp(self):
+        # Async dispatcher only : the event must be set from the loop thread
+        if self.bridge.inLoop():
+            self._wakeup.set()
+        else:
+            self.eventloop.call_soon_threadsafe(self._wakeup.set)
 
 
     def setEventLoop (self, eloop):
@@ -91,49 +239,152 @@ class RunSM:
 
         logger.debug("This is the State Machine Manager - > Starting services...")
         self.eventloop = eloop
-        t = Thread(target=self.runsm, args=())
-        t.start();
+        self.bridge.bind(eloop)
+        self.timers.bind(eloop)
+
+        if self.dispatch == DISPATCH.ASYNC:
+            self._wakeup = asyncio.Event()
+            eloop.create_task(self.runsm_async())
+        elif self.dispatch == DISPATCH.REALMS:
+            self.startWorkers()
+        else:
+            t = Thread(target=self.runsm, args=())
+            t.start();
+            self._dispatch_threads.add(t.ident)
+
+    def startWorkers(self):
+        # One ordered queue and one worker thread per realm
+        for realm in self.smstates.realms:
+            self.workers[realm] = RealmWorker(self, realm)
+
+        # Hand over what is already stacked (IDLE is not needed here), top of stack first
+        pending = [entry for entry in reversed(self._states_stack1) if entry[0] is not self._idle]
+        del self._states_stack1[:]
+        for tstate, payload, origin in pending:
+            signal = Signal(self, verb=tstate.sname, payload=payload)
+            signal.origin = origin
+            self.routeSignal(signal)
+        # and the signals registered before go(), which nothing else would drain in this mode
+        for signal in self.signal_queue.drain():
+            if 'LOADSTATE' in signal.type:
+                self.routeSignal(signal)
+            else:
+                Signal.release(signal)
+
+        for worker in self.workers.values():
+            worker.start()
+
+    def runRealmState(self, tstate, payload, realm, origin = None):
+        # Run a state and, depth first, the same realm states it returns. Returned states
+        # owned by other realms are routed to their workers
+        stack = [(tstate, payload)]
+        byname = self.smstates.byname
+        while stack:
+            current_state, payload = stack.pop()
+            if current_state is self._idle:
+                continue
+            t0 = time.perf_counter()
+            self._ctx.origin = origin
+            self.bridge.beginStep()
+            try:
+                states_to_load = current_state.func(payload)
+            except Exception as e:
+                logger.info("State {} failed due: {}".format(current_state.sname, e.__repr__()))
+                states_to_load = None
+            finally:
+                self.bridge.endStep()
+                self._ctx.origin = None
+            self.stats.forState(current_state).record(time.perf_counter() - t0)
+
+            if states_to_load != None:
+                for lstate in states_to_load:
+                    nstate = byname[lstate]
+                    if nstate.realm == realm:
+                        stack.append((nstate, None))
+                    elif nstate is not self._idle:
+                        signal = Signal(self, verb=lstate)
+                        signal.op = nstate.op
+                        signal.origin = origin
+                        self.workers[nstate.realm].put(signal, False)
+
+    def realmsReport(self) -> str:
+        if not self.workers:
+            return 'Realm dispatcher is not active'
+        lines = ['{:<8}{:>10}{:>7}{:>10}{:>13}{:>13}{:>10}'.format(
+                    'Realm', 'Processed', 'Depth', 'MaxDepth', 'AvgLat(ms)', 'MaxLat(ms)', 'Busy(s)')]
+        for worker in self.workers.values():
+            lines.append(worker.report())
+        return '\n\r'.join(lines) + '\n\r'
+
+    def admitSignals(self):
+        # Drain up to batch_cap signals (highest priority lane first) into the states stack.
+        # The stack is LIFO, so push them backwards to keep the drain order on execution
+        depth = self.signal_queue.qsize()
+        signals = self.signal_queue.drain(self.batch_cap)
+        now = time.perf_counter()
+        ops = self.smstates.states
+        stack = self._states_stack1
+        for signal in reversed(signals):
+            if 'LOADSTATE' in signal.type :
+                tstate = ops[signal.op]
+                self.stats.forState(tstate).recordWait(now - signal.ts)
+                stack.append((tstate, signal.payload, signal.origin))
+            Signal.release(signal)
+        self.stats.depths(depth, len(self._states_stack1))
+
+    def runState(self):
+        # Execute the state on top of the stack and load the states it returns
+        current_state, payload, origin = self._states_stack1.pop()
+        t0 = time.perf_counter()
+        self._ctx.origin = origin
+        self.bridge.beginStep()
+        try:
+            states_to_load = current_state.func(payload)
+        except Exception as e:
+            # One bad handler must not stop the dispatcher
+            logger.info("State {} failed due: {}".format(current_state.sname, e.__repr__()))
+            states_to_load = None
+        finally:
+            self.bridge.endStep()
+            self._ctx.origin = None
+        self.stats.forState(current_state).record(time.perf_counter() - t0)
+
+        if states_to_load != None:
+            byname = self.smstates.byname
+            for lstate in states_to_load:
+                self._states_stack1.append((byname[lstate], None, origin))
+
+    def runBatch(self):
+        # One dispatcher tick : admit a batch of signals and run the stack down to IDLE
+        self.admitSignals()
+        while self.__running:
+            if (self._states_stack1.__len__()) == 0:
+                self.__running = False
+            elif self._states_stack1[-1][0] is self._idle:
+                return
+            else:
+                self.runState()
+
+    async def runsm_async(self):
+        # Event driven dispatcher : sleeps on the loop until registerSignal wakes it up
+        while self.__running:
+            self.runBatch()
+            if not self.__running:
+                break
+            if self.signal_queue.empty():
+                await self._wakeup.wait()
+                self._wakeup.clear()
+            else:
+                # Batch cap reached, let the loop breathe before the next one
+                await asyncio.sleep(0)
 
     def runsm(self):
         # -
-        payload = ''
-
         while self.__running:
             time.sleep(0.1)
-            if self.timer_counter > 0:
-                self.timer_counter -= 1
-                # if self.timer_counter % 10000 == 0:
-                #     dispatcher.send(message=" ", signal=SIGNALS.TERM_SHOWTIMER, sender=ENTITIES.RUNSM)
-            else:
-                # Execute @ states stack top
-                if (self._states_stack1.__len__()) == 0:
-                    self.__running = False
-                else:
-                    # Do signal housekeeping
-                    if not self.signal_queue.empty():
-                        signal = self.signal_queue.get()
-                        if 'LOADSTATE' in signal.type :
-                            self.callState ( signal.verb, signal.getpayload())
-
-                    current_state = self._states_stack1.pop()
-                    payload = current_state.pop_payload()
-                    states_to_load = current_state.func(payload)
-
-                    if states_to_load != None:
-                        for lstate in states_to_load:
-                            statereturn = self.smstates.getNewState(lstate)
-                            # if statereturn != 2 :
-                            #     print ('State returned {}'.format(statereturn))
-                            self._states_stack1.append(statereturn)
-
-                if self.timer_reload != 0:
-                    self.timer_counter = self.timer_reload
+            self.runBatch()
 
 
-    def runsm_dispatcher_script(self, message):
-        logger.debug('Signal Script with payload : {}'.format(message))
-        self.execute_script(message)
-
     def runsm_dispatcher_receive(self, message):
         # logger.debug('Signal Received with payload : {}'.format(message))
         self.__signal_queue.put_nowait(message)
@@ -147,60 +398,6 @@ class RunSM:
 
 
 
-    def set_timer(self, payload):
-
-        iterpl = iter(payload)
-        cmds = dict(zip(iterpl, iterpl));
-        # cmds = dict(map(None, *[iterpl] * 2))
-
-        timer_clear = cmds.get("clear")
-        timer_value = cmds.get("set")
-
-        if timer_clear is not None:
-            self.timer_reload = 0
-
-        elif timer_value is not None:
-            self.timer_reload = int(timer_value) * 1000
-            self.do_timer();
-
-    def do_timer(self):
-
-        self.tmr = Timer(5.0, self.do_timer)
-        self.tmr.start()
-        logger.debug("Timer callback !")
-
-    def get_signal_cmd(self, local_signal):
-
-        vb_tokens = re.findall('\'\S*\'', local_signal)
-        for token0 in vb_tokens:
-            token1 = token0.replace('\'', '')
-            token1 = token1.replace(' ', '|')
-            token1 = token1.replace('=', '^')
-            local_signal = local_signal.replace(token0, token1)
-
-        tokens = re.split(r'[=\s]\s*', local_signal)
-
-        for i in range(0, tokens.__len__()):
-            tokens[i] = tokens[i].replace('|', ' ')
-            tokens[i] = tokens[i].replace('^', '=')
-
-        payload = tokens[1:]
-
-        return tokens[0].upper(), payload
-
-
-    def push_cmd(self, signal):
-        cmd, payload = self.get_signal_cmd(signal)
-        if self.smstates.sindex(cmd) in self._states_lookup:
-            pstate = self.smstates.findState(cmd)
-            if pstate != None:
-                pstate.push_payload(payload)
-            self._states_stack.append(self.smstates.sindex(cmd))
-            # logger.debug("Valid Signal received : {}".format(cmd))
-        else:
-            logger.warn("Syntax Error : {}".format(cmd))
-
-
     def configLogger(self, qlog):
 
         logger.setLevel(logging.DEBUG)
@@ -217,26 +414,217 @@ class RunSM:
 
     # STATES ===========================================================================================================
 
-    # ROOT:INIT
+    @state("ROOT", "INIT")
     def sm_init(self, payload):
         pass
         # logger.debug("Em Init State")
 
-    # ROOT:CONFIG
+    @state("ROOT", "CONFIG")
     def sm_config(self, payload):
         logger.debug("Em Config State")
         # self.pserial.sendRawData(payload)
 
-    # ROOT:IDLE
+    @state("ROOT", "IDLE")
     def sm_idle(self, payload):
         # self._states_stack.append(self.smstates.sindex("IDLE"))
         return ['IDLE']
 
-    # ROOT:EXIT
+    @state("ROOT", "EXIT")
     def sm_exit(self, payload):
         os._exit(0)
 
+    @state("ROOT", "TIMER")
+    def sm_timer(self, payload):
+        # TIMER                              -> list active timers
+        # TIMER EVERY|AFTER <ms> VERB [args] -> periodic / one shot signal VERB
+        # TIMER CLEAR [id]                   -> cancel one or all timers
+        tokens = payload if isinstance(payload, list) else ['TIMER']
+        # The timer service belongs to the loop thread, whatever thread dispatches
+        self.bridge.call(self.timerCommand, tokens, self.currentOrigin())
+
+    def timerCommand(self, tokens, origin):
+        # Loop thread only
+        if len(tokens) == 1:
+            lines = ['Timer {} : {} every {} ms, fired {}, missed {}'.format(
+                        t.id, t.args[1], int((t.period or 0) * 1000), t.fired, t.missed)
+                     for t in self.timers.active('TIMER')]
+            report = '\n\r'.join(lines) + '\n\r' if lines else 'No active timers'
+        elif tokens[1] == 'CLEAR':
+            if len(tokens) > 2:
+                timer = self.timers.timers.get(int(tokens[2])) if tokens[2].isdigit() else None
+                if timer is None or timer.tag != 'TIMER':
+                    report = 'No timer {}'.format(tokens[2])
+                else:
+                    self.timers.cancel(timer)
+                    report = 'Timer {} cleared'.format(timer.id)
+            else:
+                # Internal timers (telemetry sampler, script steps ...) are not the console's to clear
+                self.timers.cancelAll('TIMER')
+                report = 'Timers cleared'
+        elif tokens[1] in ('EVERY', 'AFTER') and len(tokens) > 3:
+            try:
+                delay = float(tokens[2]) / 1000
+            except Exception as e:
+                report = "Can't convert parameter due: {}".format(e.__repr__())
+            else:
+                if not delay > 0:
+                    report = 'Timer delay must be a positive number of ms, got {}'.format(tokens[2])
+                elif not self.hasState(tokens[3]):
+                    report = 'Unknown state {}'.format(tokens[3])
+                elif tokens[1] == 'EVERY':
+                    timer = self.timers.signalEvery(self, delay, tokens[3], tokens[3:], origin, 'TIMER')
+                    report = 'Timer {} fires {} every {} ms'.format(timer.id, tokens[3], tokens[2])
+                else:
+                    timer = self.timers.signalLater(self, delay, tokens[3], tokens[3:], origin, 'TIMER')
+                    report = 'Timer {} fires {} in {} ms'.format(timer.id, tokens[3], tokens[2])
+        else:
+            report = 'Usage : TIMER [EVERY|AFTER <ms> VERB args | CLEAR [id]]'
+
+        signal = Signal(self, verb='TCPCALLBACK', payload=report)
+        signal.origin = origin
+        self.registerSignal(signal)
+
+    @state("ROOT", "SCRIPT")
+    def sm_script(self, payload):
+        # SCRIPT <name> [FAST] : run a compiled scenario from script_dir, FAST ignores WAITs
+        tokens = payload if isinstance(payload, list) else ['SCRIPT']
+        if len(tokens) < 2:
+            self.registerSignal(Signal(self, verb='TCPCALLBACK', payload='Usage : SCRIPT <name> [FAST]'))
+            return
+
+        try:
+            script = self.scripts.load(findFile(self.script_dir, tokens[1], 'script'))
+        except Exception as e:
+            self.registerSignal(Signal(self, verb='TCPCALLBACK', payload="Can't load script due: {}".format(e)))
+            return
+
+        script.runs += 1
+        end = (self.smstates.byname['SCRIPTEND'], (script, time.perf_counter()))
+        if script.timed() and 'FAST' not in tokens[2:]:
+            groups = script.groups()
+            origin = self.currentOrigin()
+            for offset, steps in groups[:-1]:
+                self.timers.signalLater(self, offset, 'SCRIPTSTEPS', script.entries(steps), origin)
+            offset, steps = groups[-1]
+            self.timers.signalLater(self, offset, 'SCRIPTSTEPS', script.entries(steps) + [end], origin)
+        else:
+            self.loadStates(script.entries() + [end])
+
+    @state("ROOT", "SCRIPTSTEPS")
+    def sm_scriptSteps(self, payload):
+        # Internal : a group of compiled steps released by the timer service
+        if isinstance(payload, list) and payload and isinstance(payload[0], tuple):
+            self.loadStates(payload)
+
+    @state("ROOT", "SCRIPTEND")
+    def sm_scriptEnd(self, payload):
+        if not isinstance(payload, tuple):
+            return
+        script, t0 = payload
+        wall = time.perf_counter() - t0
+        rate = len(script.steps) / wall if wall > 0 else 0.0
+        self.registerSignal(Signal(self, verb='TCPCALLBACK',
+                                   payload='Script {} : {} steps in {:.3f} ms ({:.0f} steps/s)'.format(
+                                       script.name, len(script.steps), wall * 1000, rate)))
+
+    @state("ROOT", "STATS")
+    def sm_stats(self, payload):
+        # STATS [JSON|RESET] : per state timings, signal wait times and queue depths
+        tokens = payload if isinstance(payload, list) else ['STATS']
+        if 'RESET' in tokens[1:]:
+            self.stats.reset()
+            self.bridge.resetCounters()
+            report = 'Stats cleared'
+        elif 'JSON' in tokens[1:]:
+            report = self.stats.dumpJson(self.queueCounters(), self.bridge.counters())
+        else:
+            report = self.stats.report(self.queueCounters(), self.bridge.counters())
+        self.registerSignal(Signal(self, verb='TCPCALLBACK', payload=report))
+
+    @state("ROOT", "TRACE")
+    def sm_trace(self, payload):
+        # TRACE START [name] / TRACE STOP : record every registered signal under trace_dir
+        tokens = payload if isinstance(payload, list) else ['TRACE']
+        if 'START' in tokens[1:]:
+            if self.recorder is not None:
+                report = 'Already recording to {}'.format(self.recorder.path)
+            else:
+                name = tokens[2].lower() if len(tokens) > 2 else time.strftime('%Y%m%d_%H%M%S')
+                os.makedirs(self.trace_dir, exist_ok=True)
+                self.recorder = TraceRecorder(os.path.join(self.trace_dir, name + '.trc'))
+                report = 'Recording signals to {}'.format(self.recorder.path)
+        elif 'STOP' in tokens[1:] and self.recorder is not None:
+            recorder = self.recorder
+            self.recorder = None
+            recorder.close()
+            report = '{} signals recorded to {}'.format(recorder.records, recorder.path)
+        else:
+            report = 'Recording to {}'.format(self.recorder.path) if self.recorder else 'Not recording'
+        self.registerSignal(Signal(self, verb='TCPCALLBACK', payload=report))
 
+    @state("ROOT", "REALMS")
+    def sm_realms(self, payload):
+        self.registerSignal(Signal(self, verb='TCPCALLBACK', payload=self.realmsReport()))
+
+
+
+class RealmWorker:
+
+    def __init__(self, runsm, realm):
+
+        self.runsm = runsm
+        self.realm = realm
+        # Single lane : signals of one realm run strictly in arrival order
+        self.queue = SignalQueue(lanes_map={}, maxsize=runsm.queue_size)
+
+        self.processed = 0
+        self.maxdepth = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.busy = 0.0
+
+    def start(self):
+        t = Thread(target=self.run, name='realm-' + self.realm, daemon=True)
+        t.start()
+        self.runsm._dispatch_threads.add(t.ident)
+
+    def put(self, signal, block=True):
+        signal.ts = time.perf_counter()
+        depth = self.queue.put(signal, block)
+        if depth > self.maxdepth:
+            self.maxdepth = depth
+        self.runsm.stats.depths(depth, 0)
+        return depth
+
+    def run(self):
+        ops = self.runsm.smstates.states
+        while self.runsm.isRunning():
+            for signal in self.queue.wait(self.runsm.batch_cap, 0.5):
+                if 'LOADSTATE' not in signal.type:
+                    Signal.release(signal)
+                    continue
+                t0 = time.perf_counter()
+                tstate = ops[signal.op]
+                payload = signal.payload
+                self.runsm.stats.forState(tstate).recordWait(t0 - signal.ts)
+                self.runsm.runRealmState(tstate, payload, self.realm, signal.origin)
+                if signal.then is not None:
+                    self.runsm.routeChain(signal.then, signal.origin)
+                t1 = time.perf_counter()
+
+                latency = t1 - signal.ts
+                Signal.release(signal)
+                self.processed += 1
+                self.latency_sum += latency
+                if latency > self.latency_max:
+                    self.latency_max = latency
+                self.busy += t1 - t0
+
+    def report(self) -> str:
+        avg = (self.latency_sum / self.processed) * 1000 if self.processed else 0.0
+        return '{:<8}{:>10}{:>7}{:>10}{:>13.3f}{:>13.3f}{:>10.3f}'.format(
+                    self.realm, self.processed, self.queue.qsize(), self.maxdepth,
+                    avg, self.latency_max * 1000, self.busy)
 
 
 
@@ -244,34 +632,6 @@ class RunSM:
 
 
 
-    # def execute_script(self, script_list, rv=True):
-    #     #
-    #     if rv == True:
-    #         for line in reversed(script_list):
-    #             self.push_cmd(line)
-    #     else:
-    #         for line in script_list:
-    #             self.push_cmd(line)
-    #
-    # def load_script(self, payload):
-    #     #
-    #     cmds = list()
-    #     if payload.__len__() == 0:
-    #         logger.warning("Load from nothing ?")
-    #     else:
-    #         scriptpath = payload[0]
-    #         logger.info("Loading script from file %s", scriptpath)
-    #         file_obj = open(scriptpath, 'r')
-    #         # script= ''.join(file_obj.readlines())
-    #         lines = (line.strip() for line in file_obj)
-    #         for line in lines:
-    #             if line != "" and line[0] != "#":
-    #                 logger.debug("Pushing cmd : {}".format(line))
-    #                 cmds.append(line)
-    #
-    #         if cmds:
-    #             self.execute_script(cmds)
-    #         file_obj.close()
 
 
     # def eval_test(self, payload):
@@ -293,25 +653,18 @@ class RunSM:
 
 
 
-        # self.smstates.addState("LOAD_SCRIPT", 0, "ROOT")
-        # self._states_lookup[self.smstates.sindex("LOAD_SCRIPT")] = self.load_script
-        #
         # self.smstates.addState("EVAL", 0, "ROOT")
         # self._states_lookup[self.smstates.sindex("EVAL")] = self.eval_test
-        #
-        # self.smstates.addState("TIMER", 0, "ROOT")
-        # self._states_lookup[self.smstates.sindex("TIMER")] = self.set_timer
+
 
 
 
         # dispatcher.connect(self.runsm_dispatcher_receive, signal=SIGNALS.TERM_CMD, sender=dispatcher.Any)
         # dispatcher.connect(self.runsm_dispatcher_quit, signal=SIGNALS.QUIT, sender=dispatcher.Any)
-        # dispatcher.connect(self.runsm_dispatcher_script, signal=SIGNALS.SCRIPT, sender=dispatcher.Any)
 
         # sitecode.addStates(self.smstates, self._states_lookup)
         # self.tornado.addStates(self.smstates, self._states_lookup)
         # self.topo.addStates(self.smstates, self._states_lookup)
-        # self.do_timer()
 
 
         # self._states_lookup = {}
@@ -0,0 +1,96 @@
+import logging
+import os
+import shlex
+
+from BSP import SMStates
+
+logger = logging.getLogger(__name__)
+
+
+class ScriptStep:
+
+    __slots__ = ('state', 'payload', 'offset')
+
+    def __init__(self, state, payload, offset):
+        self.state = state          # SMState resolved at compile time
+        self.payload = payload      # Console style tokens [VERB, args...]
+        self.offset = offset        # Seconds from script start
+
+
+class Script:
+
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = steps
+        self.duration = steps[-1].offset if steps else 0.0
+        self.runs = 0
+
+    def timed(self) -> bool:
+        return self.duration > 0
+
+    def entries(self, steps=None) -> list:
+        # (state, payload) pairs ready for RunSM.loadStates. Payload lists are copied because
+        # some handlers consume their tokens in place
+        return [(step.state, list(step.payload)) for step in (self.steps if steps is None else steps)]
+
+    def groups(self) -> list:
+        # Steps sharing the same offset, in order : [(offset, [steps]), ...]
+        out = []
+        for step in self.steps:
+            if out and out[-1][0] == step.offset:
+                out[-1][1].append(step)
+            else:
+                out.append((step.offset, [step]))
+        return out
+
+
+def compileScript(name, lines, smstates:SMStates) -> Script:
+    # Scenario syntax, one command per line :
+    #   # comment
+    #   WAIT <ms>           -> delay the following steps
+    #   VERB [args ...]     -> same tokens as typed on the console, quotes keep spaces
+    steps = []
+    offset = 0.0
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if line == "" or line[0] == "#":
+            continue
+        try:
+            tokens = shlex.split(line.upper())
+        except ValueError as e:
+            raise ValueError("{} line {} : {}".format(name, lineno, e))
+
+        if tokens[0] == 'WAIT':
+            try:
+                offset += float(tokens[1]) / 1000
+            except Exception:
+                raise ValueError("{} line {} : WAIT needs a delay in ms".format(name, lineno))
+            continue
+
+        tstate = smstates.findState(tokens[0])
+        if tstate is None:
+            raise ValueError("{} line {} : unknown state {}".format(name, lineno, tokens[0]))
+        steps.append(ScriptStep(tstate, tokens, offset))
+
+    return Script(name, steps)
+
+
+class ScriptCache:
+
+    # Compiled scripts keyed by path, recompiled only when the file changes
+
+    def __init__(self, smstates:SMStates):
+        self.smstates = smstates
+        self.scripts = dict()
+
+    def load(self, path) -> Script:
+        mtime = os.stat(path).st_mtime
+        cached = self.scripts.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        logger.info("Compiling script from file %s", path)
+        with open(path, 'r') as file_obj:
+            script = compileScript(os.path.basename(path), file_obj.readlines(), self.smstates)
+        self.scripts[path] = (mtime, script)
+        return script
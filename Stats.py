@@ -0,0 +1,167 @@
+import json
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+
+class StateStats:
+
+    # Counters for one state. Durations of the last `window` calls are kept in a ring
+    # so percentiles can be computed on demand without growing memory
+
+    __slots__ = ('name', 'realm', 'calls', 'total', 'max', 'ring', 'pos',
+                 'waits', 'wait_total', 'wait_max')
+
+    def __init__(self, name, realm, window):
+        self.name = name
+        self.realm = realm
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.ring = array('d', bytes(8 * window))
+        self.pos = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.ring[self.pos] = elapsed
+        self.pos = (self.pos + 1) % len(self.ring)
+
+    def recordWait(self, wait):
+        self.waits += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+
+    def percentiles(self, *pcts) -> list:
+        n = min(self.calls, len(self.ring))
+        if n == 0:
+            return [0.0 for _ in pcts]
+        samples = sorted(self.ring[:n])
+        return [samples[min(n - 1, int(n * p / 100))] for p in pcts]
+
+    def asDict(self) -> dict:
+        p50, p90, p99 = self.percentiles(50, 90, 99)
+        return {
+            'state'     : self.name,
+            'realm'     : self.realm,
+            'calls'     : self.calls,
+            'total_ms'  : self.total * 1000,
+            'mean_ms'   : (self.total / self.calls) * 1000 if self.calls else 0.0,
+            'p50_ms'    : p50 * 1000,
+            'p90_ms'    : p90 * 1000,
+            'p99_ms'    : p99 * 1000,
+            'max_ms'    : self.max * 1000,
+            'waits'     : self.waits,
+            'wait_mean_ms' : (self.wait_total / self.waits) * 1000 if self.waits else 0.0,
+            'wait_max_ms'  : self.wait_max * 1000,
+        }
+
+
+class TickStats:
+
+    # Lateness of a periodic task against its absolute deadlines, plus the periods it skipped
+    # or sent late to catch up
+
+    def __init__(self, name, realm, window=1024):
+        self.name = name
+        self.realm = realm
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.lateness = StateStats(self.name, self.realm, self.window)
+        self.missed = 0
+        self.caught_up = 0
+        self.started = None
+        self.last = None
+
+    def tick(self, now, deadline):
+        if self.started is None:
+            self.started = now
+        self.last = now
+        self.lateness.record(now - deadline)
+
+    def asDict(self, period) -> dict:
+        p50, p99 = self.lateness.percentiles(50, 99)
+        ticks = self.lateness.calls
+        span = (self.last - self.started) if ticks > 1 else 0.0
+        return {
+            'name'          : self.name,
+            'ticks'         : ticks,
+            'missed'        : self.missed,
+            'caught_up'     : self.caught_up,
+            'period_ms'     : period * 1000,
+            'rate_hz'       : (ticks - 1) / span if span > 0 else 0.0,
+            'late_mean_ms'  : (self.lateness.total / ticks) * 1000 if ticks else 0.0,
+            'late_p50_ms'   : p50 * 1000,
+            'late_p99_ms'   : p99 * 1000,
+            'late_max_ms'   : self.lateness.max * 1000,
+        }
+
+    def report(self, period) -> str:
+        d = self.asDict(period)
+        return ('{name} : {ticks} ticks at {rate_hz:.3f} Hz (period {period_ms:.1f} ms), missed {missed}, '
+                'caught up {caught_up}\n\rLateness ms : mean {late_mean_ms:.3f}  p50 {late_p50_ms:.3f}  '
+                'p99 {late_p99_ms:.3f}  max {late_max_ms:.3f}\n\r').format(**d)
+
+
+class RunStats:
+
+    def __init__(self, window=512):
+        self.window = window
+        self.states = dict()
+        self.max_signal_depth = 0
+        self.max_stack_depth = 0
+
+    def forState(self, tstate) -> StateStats:
+        sstats = self.states.get(tstate.sname)
+        if sstats is None:
+            sstats = self.states[tstate.sname] = StateStats(tstate.sname, tstate.realm, self.window)
+        return sstats
+
+    def depths(self, signal_depth, stack_depth):
+        if signal_depth > self.max_signal_depth:
+            self.max_signal_depth = signal_depth
+        if stack_depth > self.max_stack_depth:
+            self.max_stack_depth = stack_depth
+
+    def reset(self):
+        self.states = dict()
+        self.max_signal_depth = 0
+        self.max_stack_depth = 0
+
+
+    def dump(self, queue=None, bridge=None) -> dict:
+        return {
+            'max_signal_depth'  : self.max_signal_depth,
+            'max_stack_depth'   : self.max_stack_depth,
+            'queue'             : queue or {},
+            'bridge'            : bridge or {},
+            'states'            : [s.asDict() for s in self.states.values()],
+        }
+
+    def dumpJson(self, queue=None, bridge=None) -> str:
+        return json.dumps(self.dump(queue, bridge))
+
+    def report(self, queue=None, bridge=None) -> str:
+        lines = ['{:<16}{:<8}{:>8}{:>11}{:>10}{:>10}{:>10}{:>10}{:>11}{:>10}'.format(
+                    'State', 'Realm', 'Calls', 'Total(ms)', 'Mean', 'p50', 'p99', 'Max', 'Wait mean', 'Wait max')]
+        for s in sorted(self.states.values(), key=lambda s: s.total, reverse=True):
+            d = s.asDict()
+            lines.append('{:<16}{:<8}{:>8}{:>11.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}{:>11.3f}{:>10.3f}'.format(
+                    s.name, s.realm, s.calls, d['total_ms'], d['mean_ms'], d['p50_ms'], d['p99_ms'],
+                    d['max_ms'], d['wait_mean_ms'], d['wait_max_ms']))
+        lines.append('Max signal queue depth : {}   Max states stack depth : {}'.format(
+                    self.max_signal_depth, self.max_stack_depth))
+        if queue:
+            lines.append('Signal queue : ' + '  '.join('{} {}'.format(k, v) for k, v in queue.items()))
+        if bridge:
+            lines.append('Loop bridge : ' + '  '.join('{} {}'.format(k, v) for k, v in bridge.items()))
+        return '\n\r'.join(lines) + '\n\r'
@@ -0,0 +1,93 @@
+import logging
+
+from RunSM import RunSM
+from BSP import DISPATCH
+from Instrument import Instrument
+from PSerial import PSerial
+from TCPServer import TCPServer
+
+logger = logging.getLogger(__name__)
+
+
+class StubSerial:
+
+    def __init__(self):
+        self.rts = False
+
+
+class StubTransport:
+
+    # Stands in for the serial / TCP transports when there is no device or peer.
+    # Writes are counted, and kept only when keep is set
+
+    def __init__(self, peername=('stub', 0), keep=False):
+        self.serial = StubSerial()
+        self.peername = peername
+        self.keep = keep
+        self.data = list()
+        self.writes = 0
+        self.nbytes = 0
+        self.closing = False
+        self.reading = True
+
+    def write(self, data):
+        self.writes += 1
+        self.nbytes += len(data)
+        if self.keep:
+            self.data.append(bytes(data))
+
+    def writelines(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return self.peername
+        return default
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def is_closing(self):
+        return self.closing
+
+    def close(self):
+        self.closing = True
+
+    def abort(self):
+        self.closing = True
+
+
+def buildStubStack(dispatch=DISPATCH.ASYNC, keep=False, qlog=None) -> RunSM:
+    # Full RunSM with its services wired to stub transports, not started (call go() or runBatch())
+    pserial = PSerial(qlog)
+    pserial.transport = StubTransport(('serial', 0), keep)
+    tcps = TCPServer(qlog)
+    instrument = Instrument(qlog)
+
+    sm = RunSM(qlog, pserial, tcps, instrument, dispatch)
+    pserial.setRunSM(sm)
+    tcps.setRunSM(sm)
+    instrument.setRunSM(sm)
+    pserial.setInstrument(instrument)
+
+    stubSession(sm, keep)
+    return sm
+
+
+def stubSession(sm, keep=False, peername=('console', 0), factory=None):
+    # A console session (or any other kind from factory) registered in RunSM without going through connection_made
+    session = (factory or sm.tcpserver.protocolFactory)()
+    session.transport = StubTransport(peername, keep)
+    session.peername = peername
+    sm.registerSession(session)
+    return session
@@ -1,75 +1,447 @@
 import asyncio
 import logging
+import os
+import re
+import stat
 
 import serial_asyncio
 import time
 
 import RunSM
-from BSP import Signal
+from BSP import Signal, state
+from History import HistoryRing, SharedHistory
 
 logger = logging.getLogger(__name__)
 
-class TCPServer(asyncio.Protocol):
 
+# Console input framing
+LINE_MAX = 4096
+EOL = re.compile(rb'[\r\n]')
+# Telnet IAC sequences : option negotiation, sub negotiation, two byte commands
+TELNET = re.compile(rb'\xff(?:[\xfb-\xfe].|\xfa.*?\xff\xf0|[\x00-\xfe])', re.S)
+UP_ARROW = b'\x1b[A'
+# Input is held while the signal queue is this full, and released below HOLD_LOW
+HOLD_HIGH = 0.75
+HOLD_LOW = 0.25
+HOLD_POLL = 0.005
 
-    def __init__(self, qlog = None):
+
+class TCPSession(asyncio.Protocol):
+
+    # One console connection. Created by TCPServer.protocolFactory for every client,
+    # registered in RunSM.sessions while connected
+
+    def __init__(self, server):
         super().__init__()
-        self._transport = None
-        self.runsm :RunSM
+        self.server :TCPServer = server
+        self.runsm :RunSM = server.runsm
+        self.transport = None
+        self.peername = None
+        self.sid = 0
 
-        self.prompt = "opus@virna5:"
+        self.inbuf = bytearray()
+        self.skip_lf = False
+        self.held = False
+        self.history = HistoryRing(server.history_size)
 
-        self.configLogger(qlog)
+        # Output gathered during one loop turn, see reply / flush
+        self.outbuf = list()
+        self.prompt_due = False
+        self.flush_scheduled = False
+
+        # Flow control : output is parked while the transport is over its high watermark
+        self.write_high = server.write_high
+        self.write_low = server.write_low
+        self.paused = False
+        self.parked = bytearray()
+        self.slow_handle :asyncio.TimerHandle = None
+
+        self.bytes_out = 0
+        self.writes = 0
+        self.pauses = 0
+        self.peak_buffered = 0
+        self.dropped = 0
+        self.dropped_unreported = 0
 
 
     def connection_made(self, transport):
-        peername = transport.get_extra_info('peername')
-        print('Connection from {}'.format(peername))
+        # Unix socket peers have no name, show the socket path instead
+        self.peername = transport.get_extra_info('peername') or ('unix', transport.get_extra_info('sockname'))
+        print('Connection from {}'.format(self.peername))
         self.transport = transport
-        self.transport.write(b'\x1b[2J')
+        self.setLimits(self.write_high, self.write_low)
 
-        self.sm_showCallback('Welcome to Virna Python  V5.0 @ {}'.format(peername))
-        self.runsm.registerSignal(Signal(self, verb='RESTARTINSTRU'))
+        # Only the first operator restarts the instrument, later ones join the running session
+        first = not self.runsm.sessions
+        self.runsm.registerSession(self)
+        self.greet()
+        if first:
+            self.runsm.registerSignal(Signal(self, verb='RESTARTINSTRU'))
 
+    def greet(self):
+        self.send(b'\x1b[2J', prompt=False)
+        self.showText('Welcome to Virna Python  V5.0 @ {}'.format(self.peername))
 
+    def connection_lost(self, exc):
+        print('Connection from {} closed'.format(self.peername))
+        if self.slow_handle is not None:
+            self.slow_handle.cancel()
+            self.slow_handle = None
+        self.runsm.unregisterSession(self)
 
-    def setRunSM(self, rsm):
-        self.runsm = rsm
+
+    def setLimits(self, high, low=None):
+        # Loop thread only : write buffer watermarks in bytes, kept only once the transport took them
+        low = high // 4 if low is None else low
+        self.transport.set_write_buffer_limits(high, low)
+        self.write_high = high
+        self.write_low = low
+
+    def pause_writing(self):
+        self.paused = True
+        self.pauses += 1
+        self.slow_handle = self.runsm.bridge.loop.call_later(
+            self.server.slow_timeout, self.disconnect,
+            'over its write buffer limit for {} s'.format(self.server.slow_timeout))
+
+    def resume_writing(self):
+        self.paused = False
+        if self.slow_handle is not None:
+            self.slow_handle.cancel()
+            self.slow_handle = None
+
+        if self.dropped_unreported:
+            self.parked[:0] = self.encodeEvent('[{} bytes of output dropped]\n\r'.format(self.dropped_unreported))
+            self.dropped_unreported = 0
+        if self.parked:
+            data = bytes(self.parked)
+            self.parked.clear()
+            self.write(data)
+
+    def disconnect(self, reason):
+        logger.info("Closing session {} {} : {}".format(self.sid, self.peername, reason))
+        self.slow_handle = None
+        self.transport.abort()
+
+    def buffered(self) -> int:
+        # Bytes written but not yet accepted by the peer, parked output included
+        if self.transport is None:
+            return 0
+        return self.transport.get_write_buffer_size() + len(self.parked)
 
 
     def data_received(self, data):
+        # Segments are not commands : a command may span several segments and one segment may
+        # hold many pipelined commands. Only the bytes added by this segment are scanned,
+        # unless reading was held with complete lines still in the buffer
+        buf = self.inbuf
+        scan = 0 if self.held else len(buf)
+        self.held = False
+        buf += data
+
+        start = 0
+        if self.skip_lf and buf[:1] in (b'\n', b'\0'):
+            start = 1
+        self.skip_lf = False
+
+        while True:
+            eol = EOL.search(buf, max(scan, start))
+            if eol is None:
+                break
+            end = eol.start()
+            line = bytes(buf[start:end])
+            start = end + 1
+            if buf[end] == 0x0d:
+                # Telnet ends lines with \r\n or \r\0, the pair may be split across segments
+                if start == len(buf):
+                    self.skip_lf = True
+                elif buf[start] in (0x0a, 0x00):
+                    start += 1
+            self.lineReceived(line)
+
+            if self.runsm.queueLoad() >= HOLD_HIGH:
+                self.holdInput()
+                break
+
+        if start:
+            del buf[:start]
+        if self.held:
+            return
+
+        # Character mode clients send the arrow key on its own, without a line end
+        arrow = buf.find(UP_ARROW, max(0, scan - start - 2))
+        if arrow >= 0:
+            del buf[arrow:arrow + len(UP_ARROW)]
+            self.showHistory()
+
+        if len(buf) > LINE_MAX:
+            logger.info("Dropping {} bytes from {} : no line end".format(len(buf), self.peername))
+            buf.clear()
+            self.showText("Line too long")
+
+    def holdInput(self):
+        # Signal queue nearly full : stop reading, the rest of the buffer waits for the dispatcher
+        self.held = True
+        self.transport.pause_reading()
+        self.runsm.bridge.loop.call_later(HOLD_POLL, self.releaseInput)
+
+    def releaseInput(self):
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.runsm.queueLoad() > HOLD_LOW:
+            self.runsm.bridge.loop.call_later(HOLD_POLL, self.releaseInput)
+            return
+        self.transport.resume_reading()
+        self.data_received(b'')
+
+
+    def lineReceived(self, line):
+
+        if 0xff in line:
+            line = TELNET.sub(b'', line)
+
+        if UP_ARROW in line:
+            self.showHistory()
+            return
 
         try :
-            message = data.decode()
+            message = line.decode()
         except Exception as e :
-            logger.info("Failed to decode message {} from peer due: {} ".format(data, e.__repr__()))
+            logger.info("Failed to decode message {} from peer due: {} ".format(line, e.__repr__()))
             return
 
         # print('Data received: {!r}'.format(message))
 
-        if b'\x1b[A' in data:
-            # print('History called')
-            self.sm_showCallback("History is {}".format("hist"))
+        message = message.replace(self.server.prompt, "")
+        message = message.upper().strip()
+        if message.startswith('!'):
+            recalled = self.recall(message)
+            if recalled is None:
+                self.showText("{} : event not found".format(message))
+                return
+            message = recalled
+            self.reply(message + '\n\r', prompt=False)
+
+        tokens = message.split()
+        if message == '':
+            self.showText("\n\r")
+        elif self.runsm.hasState(tokens[0]):
+            # tokens = tokens[1:]
+            self.history.add(message)
+            if self.server.history is not None:
+                self.server.history.add(message)
+            sig = Signal.acquire(self, verb=tokens[0], payload = tokens)
+            self.runsm.registerSignal(sig)
+        else:
+            self.showText("Syntax Error @ {}".format(message))
+
+    def recall(self, message):
+        # !! last command, !n command n, !-n n commands back, !Sn command n of the shared history
+        ref = message[1:].strip()
+        ring = self.history
+        if ref.startswith('S'):
+            ring = self.server.history
+            ref = ref[1:].strip()
+            if ring is None:
+                return None
+        if ref == '!':
+            return ring.get(-1)
+        try:
+            return ring.get(int(ref))
+        except ValueError:
+            return None
+
+    def showHistory(self):
+        # Line mode console, no editing : the up arrow lists the recent commands to recall with !n
+        self.showText(self.server.formatHistory(self.history.entries(self.server.history_shown)))
+
+
+    def showText(self, text):
+        # Loop thread only
+        self.reply(self.server.frame(text))
+
+    @staticmethod
+    def encodeEvent(data) -> bytes:
+        # Wire form of a broadcast for this kind of session
+        return bytes(data, 'utf8') if isinstance(data, str) else data
+
+    @staticmethod
+    def encodeTelemetry(t, channels, values) -> bytes:
+        fields = ' '.join('{}={}'.format(name, value) for name, value in zip(channels, values))
+        return bytes('TLM {:.3f} {}\n\r'.format(t, fields), 'utf8')
+
+    def reply(self, data, prompt=True):
+        # Loop thread only : answer to a command of this session
+        self.send(data, prompt)
+
+    def send(self, data, prompt=True):
+        # Loop thread only : str or already encoded bytes. Everything sent during one loop
+        # turn goes out as a single write, followed by one prompt
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.outbuf.append(data)
+        self.prompt_due = self.prompt_due or prompt
+        if not self.flush_scheduled:
+            loop = self.runsm.bridge.loop
+            if loop is None:
+                self.flush()
+            else:
+                self.flush_scheduled = True
+                loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        chunks = self.outbuf
+        if not chunks:
+            return
+        self.outbuf = list()
+        if self.prompt_due:
+            chunks.append(self.server.prompt)
+            self.prompt_due = False
+        if self.transport is None or self.transport.is_closing():
+            return
 
+        if all(isinstance(c, str) for c in chunks):
+            data = bytes(''.join(chunks), 'utf8')
         else:
-            message = message.replace(self.prompt, "").replace("\n", "").replace("\r", "")
-            message = message.upper().strip()
-            tokens = message.split()
-            if message == '':
-                self.sm_showCallback("\n\r")
-            elif self.runsm.hasState(tokens[0]):
-                # tokens = tokens[1:]
-                sig = Signal(self, verb=tokens[0], payload = tokens)
-                self.runsm.registerSignal(sig)
+            data = b''.join(bytes(c, 'utf8') if isinstance(c, str) else c for c in chunks)
+
+        if not self.paused:
+            self.write(data)
+            return
+
+        # Peer is not reading : keep one contiguous buffer, bounded by the session policy
+        self.parked += data
+        if len(self.parked) > self.server.park_max:
+            if self.server.slow_policy == 'CLOSE':
+                self.disconnect('{} bytes of output parked'.format(len(self.parked)))
             else:
-                self.sm_showCallback("Syntax Error @ {}".format(message))
+                self.dropped += len(self.parked)
+                self.dropped_unreported += len(self.parked)
+                self.parked.clear()
+
+    def write(self, data):
+        self.transport.write(data)
+        self.bytes_out += len(data)
+        self.writes += 1
+        buffered = self.transport.get_write_buffer_size()
+        if buffered > self.peak_buffered:
+            self.peak_buffered = buffered
+
+    def metrics(self) -> dict:
+        return {
+            'sid'           : self.sid,
+            'kind'          : type(self).__name__,
+            'peer'          : self.peername,
+            'buffered'      : self.buffered(),
+            'peak_buffered' : self.peak_buffered,
+            'parked'        : len(self.parked),
+            'paused'        : self.paused,
+            'pauses'        : self.pauses,
+            'bytes_out'     : self.bytes_out,
+            'writes'        : self.writes,
+            'dropped'       : self.dropped,
+            'write_high'    : self.write_high,
+            'write_low'     : self.write_low,
+        }
+
+
+
+class TCPServer:
+
+
+    def __init__(self, qlog = None):
+        self.runsm :RunSM
+
+        self.prompt = "opus@virna5:"
+
+        self.history_size = 64
+        self.history_shown = 10
+        self.history :SharedHistory = None
+
+        # Slow clients : transport watermarks, output parked while over them, and what to do
+        # when a client stays over (slow_timeout s) or parks more than park_max bytes (DROP | CLOSE)
+        self.write_high = 64 * 1024
+        self.write_low = 16 * 1024
+        self.park_max = 256 * 1024
+        self.slow_timeout = 30.0
+        self.slow_policy = 'DROP'
 
+        self.listeners = list()
+
+        self.configLogger(qlog)
+
+
+    def setRunSM(self, rsm):
+        self.runsm = rsm
+
+    def protocolFactory(self) -> TCPSession:
+        # For loop.create_server : one protocol instance per connection
+        return TCPSession(self)
+
+
+    async def listen(self, loop, spec, factory=None) -> asyncio.AbstractServer:
+        # spec : tcp:host:port or unix:path. Every listener feeds the same RunSM,
+        # factory picks the protocol (console sessions by default)
+        factory = factory or self.protocolFactory
+        kind, _, address = spec.partition(':')
+        if kind == 'unix':
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                # Left over by a previous run
+                os.remove(address)
+            server = await loop.create_unix_server(factory, address)
+        elif kind == 'tcp':
+            host, _, port = address.rpartition(':')
+            server = await loop.create_server(factory, host.strip('[]') or None, int(port))
+        else:
+            raise ValueError('Listener {} : expected tcp:host:port or unix:path'.format(spec))
+
+        logger.info("Listening on {}".format(spec))
+        self.listeners.append(server)
+        return server
+
+
+    def setHistory(self, path, size=512):
+        # Optional history shared by all sessions, persisted to path
+        self.history = SharedHistory(path, size)
+
+    def formatHistory(self, entries) -> str:
+        if not entries:
+            return "History is empty"
+        return '\n\r'.join('{:>5}  {}'.format(n, line) for n, line in entries)
+
+
+    def frame(self, payload) -> str:
+        # The prompt is not part of the frame, sessions add it once per burst of output
+        if isinstance(payload, list):
+            # Console style tokens (typed, scripted or timed) : drop the verb
+            payload = ' '.join(payload[1:])
+        if not payload.endswith(('\n', '\r')):
+            payload += '\n\r'
+        return payload
+
+    def broadcast(self, data, prompt=True):
+        # Loop thread only : encode once per kind of session (console, machine),
+        # hand the same buffer to every session of that kind
+        encoded = dict()
+        for session in list(self.runsm.sessions.values()):
+            kind = type(session)
+            if kind not in encoded:
+                encoded[kind] = session.encodeEvent(data)
+            session.send(encoded[kind], prompt)
+
+    def route(self, text):
+        # From a state : reply to the session that caused it, to every session for
+        # beacon / instrument events, nowhere if the requester has gone
+        origin = self.runsm.currentOrigin()
+        if origin is None:
+            self.runsm.bridge.call(self.broadcast, text)
+        elif self.runsm.hasSession(origin):
+            self.runsm.bridge.call(origin.reply, text)
 
     def sendRawData(self, data):
         # print ('data to send : ', data)
-        if isinstance(data, str):
-            data = bytes(data, 'utf8')
-        self.transport.write(data)
+        self.runsm.bridge.call(self.broadcast, data, False)
 
 
     def configLogger(self, qlog):
@@ -86,11 +458,56 @@ class TCPServer(asyncio.Protocol):
 
     # STATES ===========================================================================================================
 
-    # TCPSV:TCPCALLBACK
+    @state("TCPSV", "TCPCALLBACK")
     def sm_showCallback(self, payload):
 
-        self.sendRawData(payload)
-        if not '\n' in payload:
-            self.sendRawData('\n\r')
-        self.sendRawData(self.prompt)
+        self.route(self.frame(payload))
+
+    @state("TCPSV", "HISTORY")
+    def sm_history(self, payload):
+
+        # HISTORY [n] | HISTORY SHARED [n]
+        tokens = list(payload[1:]) if isinstance(payload, list) else []
+        origin = self.runsm.currentOrigin()
+        ring = origin.history if self.runsm.hasSession(origin) else self.history
+        if tokens and tokens[0] == 'SHARED':
+            tokens.pop(0)
+            ring = self.history
+
+        if ring is None:
+            text = "Shared history is disabled"
+        else:
+            last = int(tokens[0]) if tokens and tokens[0].isdigit() else None
+            text = self.formatHistory(ring.entries(last))
+
+        self.route(self.frame(text))
+
+    @state("TCPSV", "SESSIONS")
+    def sm_sessions(self, payload):
+
+        # SESSIONS                    -> connected sessions and their output metrics
+        # SESSIONS LIMIT high [low]   -> write buffer watermarks of this session, in bytes
+        tokens = list(payload[1:]) if isinstance(payload, list) else []
+        origin = self.runsm.currentOrigin()
+        session = getattr(origin, 'session', origin)
+
+        if tokens and tokens[0] == 'LIMIT':
+            if not self.runsm.hasSession(session):
+                text = 'SESSIONS LIMIT needs a console session'
+            elif (len(tokens) < 2 or not all(t.isdigit() for t in tokens[1:3])
+                    or (len(tokens) > 2 and int(tokens[2]) > int(tokens[1]))):
+                text = 'Usage : SESSIONS LIMIT high [low], low <= high'
+            else:
+                high = int(tokens[1])
+                low = int(tokens[2]) if len(tokens) > 2 else None
+                self.runsm.bridge.call(session.setLimits, high, low)
+                text = 'Write limits set to {} / {}'.format(high, high // 4 if low is None else low)
+        else:
+            lines = ['Session {sid} {peer} {kind} : buffered {buffered} B (peak {peak_buffered}), '
+                     'out {bytes_out} B in {writes} writes, paused {pauses} times{now}, '
+                     'parked {parked} B, dropped {dropped} B, limits {write_high}/{write_low}'.format(
+                        now=' (now)' if m['paused'] else '', **m)
+                     for m in (s.metrics() for s in list(self.runsm.sessions.values()))]
+            text = '\n\r'.join(lines) + '\n\r' if lines else 'No sessions'
 
+        self.route(self.frame(text))
@@ -0,0 +1,165 @@
+import logging
+
+from BSP import Signal, state
+
+logger = logging.getLogger(__name__)
+
+
+class Subscription:
+
+    __slots__ = ('session', 'channels', 'every', 'change', 'countdown', 'last',
+                 'sent', 'skipped', 'behind')
+
+    def __init__(self, session, channels, every, change):
+        self.session = session
+        self.channels = channels
+        self.every = every
+        self.change = change
+        self.countdown = 0
+        self.last = None
+        self.sent = 0
+        self.skipped = 0
+        self.behind = 0
+
+    def describe(self) -> str:
+        return '{} {}'.format('on change' if self.change else 'every {} samples'.format(self.every),
+                              ' '.join(self.channels))
+
+
+class Telemetry:
+
+    # Streams sensor values to subscribed sessions. One loop timer samples every channel at
+    # sample_period while anybody is subscribed, each subscription keeps every n-th sample or
+    # the samples where one of its channels changed. A sample is encoded once per kind of
+    # session and channel set, whatever the number of subscribers.
+    # Subscribers with more than slow_bytes of output buffered miss samples instead of
+    # queueing them, and are unsubscribed after drop_after samples missed in a row.
+
+    def __init__(self, runsm):
+        self.runsm = runsm
+        self.sample_period = 0.1
+        self.slow_bytes = 64 * 1024
+        self.drop_after = 100
+        self.default_rate = 1000
+
+        self.subscriptions = dict()
+        self.timer = None
+        self.t0 = None
+        self.samples = 0
+
+
+    def channels(self) -> dict:
+        values = {name.upper(): value for name, value in self.runsm.pserial.payload.xducers.items()}
+        values['SETRA'] = self.runsm.instrument.setra
+        return values
+
+
+    def subscribe(self, session, channels, every, change):
+        # Loop thread only
+        self.subscriptions[session.sid] = Subscription(session, channels, every, change)
+        if self.timer is None or self.timer.cancelled:
+            self.t0 = self.runsm.bridge.loop.time()
+            self.timer = self.runsm.timers.callEvery(self.sample_period, self.sample)
+
+    def unsubscribe(self, session):
+        # Loop thread only
+        self.subscriptions.pop(session.sid, None)
+        if not self.subscriptions and self.timer is not None:
+            self.runsm.timers.cancel(self.timer)
+            self.timer = None
+
+
+    def sample(self):
+        self.samples += 1
+        t = self.runsm.bridge.loop.time() - self.t0
+        values = self.channels()
+        encoded = dict()
+
+        for sub in list(self.subscriptions.values()):
+            session = sub.session
+            if not self.runsm.hasSession(session):
+                self.unsubscribe(session)
+                continue
+
+            picked = tuple(values[name] for name in sub.channels)
+            if sub.change:
+                if picked == sub.last:
+                    continue
+            else:
+                sub.countdown -= 1
+                if sub.countdown > 0:
+                    continue
+                sub.countdown = sub.every
+
+            if session.buffered() > self.slow_bytes:
+                sub.skipped += 1
+                sub.behind += 1
+                if sub.behind >= self.drop_after:
+                    logger.info("Telemetry : dropping slow subscriber {}".format(session.peername))
+                    self.unsubscribe(session)
+                    session.showText('Telemetry stopped : client too slow')
+                continue
+            sub.behind = 0
+
+            key = (type(session), sub.channels)
+            data = encoded.get(key)
+            if data is None:
+                data = encoded[key] = session.encodeTelemetry(t, sub.channels, picked)
+            session.send(data, prompt=False)
+            sub.last = picked
+            sub.sent += 1
+
+
+    def report(self) -> str:
+        if not self.subscriptions:
+            return 'No telemetry subscribers'
+        lines = ['Session {} {} : {}, sent {}, skipped {}'.format(
+                    sid, sub.session.peername, sub.describe(), sub.sent, sub.skipped)
+                 for sid, sub in self.subscriptions.items()]
+        return '\n\r'.join(lines) + '\n\r'
+
+
+    # STATES ===========================================================================================================
+
+    @state("TLM", "SUBSCRIBE")
+    def sm_subscribe(self, payload):
+        # SUBSCRIBE [ms | CHANGE] [channel ...]  -> stream the channels (all by default)
+        # SUBSCRIBE LIST                         -> list the subscribers
+        tokens = list(payload[1:]) if isinstance(payload, list) else []
+        origin = self.runsm.currentOrigin()
+        session = getattr(origin, 'session', origin)
+
+        if tokens and tokens[0] == 'LIST':
+            report = self.report()
+        elif not self.runsm.hasSession(session):
+            report = 'SUBSCRIBE needs a console session'
+        else:
+            every, change = None, False
+            if tokens and tokens[0] == 'CHANGE':
+                change = True
+                tokens.pop(0)
+            elif tokens and tokens[0].isdigit():
+                every = int(tokens.pop(0))
+            if every is None:
+                every = self.default_rate
+
+            known = self.channels()
+            channels = tuple(tokens) if tokens else tuple(known)
+            unknown = [name for name in channels if name not in known]
+            if unknown:
+                report = 'Unknown channel {} : {}'.format(' '.join(unknown), ' '.join(known))
+            else:
+                every = max(1, round(every / 1000 / self.sample_period))
+                self.runsm.bridge.call(self.subscribe, session, channels, every, change)
+                report = 'Telemetry {} {}'.format('on change' if change else 'every {} ms'.format(
+                            int(every * self.sample_period * 1000)), ' '.join(channels))
+
+        self.runsm.registerSignal(Signal(self, verb='TCPCALLBACK', payload=report))
+
+    @state("TLM", "UNSUBSCRIBE")
+    def sm_unsubscribe(self, payload):
+        origin = self.runsm.currentOrigin()
+        session = getattr(origin, 'session', origin)
+        if self.runsm.hasSession(session):
+            self.runsm.bridge.call(self.unsubscribe, session)
+        self.runsm.registerSignal(Signal(self, verb='TCPCALLBACK', payload='Telemetry stopped'))
@@ -0,0 +1,151 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+
+from BSP import Signal
+
+logger = logging.getLogger(__name__)
+
+
+class LoopTimer:
+
+    __slots__ = ('id', 'deadline', 'period', 'callback', 'args', 'tag', 'cancelled', 'fired', 'missed')
+
+    def __init__(self, tid, deadline, period, callback, args, tag=None):
+        self.id = tid
+        self.deadline = deadline
+        self.period = period
+        self.callback = callback
+        self.args = args
+        # Owner of the timer, so a console can list and clear its own timers only
+        self.tag = tag
+        self.cancelled = False
+        self.fired = 0
+        self.missed = 0
+
+    def __lt__(self, other):
+        return (self.deadline, self.id) < (other.deadline, other.id)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerService:
+
+    # One shot and periodic timers kept in a heap and driven by a single loop.call_at handle.
+    # No threads are created : every timer fires on the event loop thread.
+    # Periodic timers are re-armed on absolute deadlines (deadline + period) so they do not drift,
+    # periods missed while the loop was busy are skipped and counted.
+
+    def __init__(self):
+        self.loop:asyncio.AbstractEventLoop = None
+        self.loop_thread = None
+        self.heap = list()
+        self.timers = dict()
+        self.handle:asyncio.TimerHandle = None
+        self.armed_at = None
+        self.ids = itertools.count(1)
+
+
+    def bind(self, loop):
+        # Must be called from the thread that runs the loop
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+
+
+    def callLater(self, delay, callback, *args, tag=None) -> LoopTimer:
+        return self.addTimer(delay, None, callback, args, tag)
+
+    def callEvery(self, period, callback, *args, delay=None, tag=None) -> LoopTimer:
+        # A period <= 0 would never leave expire()
+        if not period > 0:
+            raise ValueError('timer period must be positive, got {}'.format(period))
+        return self.addTimer(period if delay is None else delay, period, callback, args, tag)
+
+    def signalLater(self, runsm, delay, verb, payload='', origin=None, tag=None) -> LoopTimer:
+        return self.callLater(delay, self.fireSignal, runsm, verb, payload, origin, tag=tag)
+
+    def signalEvery(self, runsm, period, verb, payload='', origin=None, tag=None) -> LoopTimer:
+        return self.callEvery(period, self.fireSignal, runsm, verb, payload, origin, tag=tag)
+
+    def fireSignal(self, runsm, verb, payload, origin=None):
+        # Periodic timers reuse their payload, and some handlers consume token lists in place
+        if isinstance(payload, list):
+            payload = list(payload)
+        signal = Signal.acquire(self, verb=verb, payload=payload)
+        signal.origin = origin
+        runsm.registerSignal(signal)
+
+
+    def addTimer(self, delay, period, callback, args, tag=None) -> LoopTimer:
+        timer = LoopTimer(next(self.ids), 0.0, period, callback, args, tag)
+        self.timers[timer.id] = timer
+        if threading.get_ident() == self.loop_thread:
+            self.schedule(timer, delay)
+        else:
+            self.loop.call_soon_threadsafe(self.schedule, timer, delay)
+        return timer
+
+    def cancel(self, timer):
+        # Lazy removal : the heap entry is dropped when it reaches the top
+        timer.cancelled = True
+        self.timers.pop(timer.id, None)
+
+    def cancelAll(self, tag=None):
+        # Every timer, or only those of one owner
+        for timer in self.active(tag):
+            self.cancel(timer)
+
+    def active(self, tag=None) -> list:
+        return sorted((t for t in self.timers.values() if tag is None or t.tag == tag), key=lambda t: t.id)
+
+
+    def schedule(self, timer, delay):
+        if timer.cancelled:
+            return
+        timer.deadline = self.loop.time() + max(delay, 0.0)
+        heapq.heappush(self.heap, timer)
+        self.arm()
+
+    def arm(self):
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return
+
+        deadline = self.heap[0].deadline
+        if self.handle is not None:
+            if self.armed_at <= deadline:
+                return
+            self.handle.cancel()
+        self.armed_at = deadline
+        self.handle = self.loop.call_at(deadline, self.expire)
+
+    def expire(self):
+        self.handle = None
+        now = self.loop.time()
+
+        while self.heap and self.heap[0].deadline <= now:
+            timer = heapq.heappop(self.heap)
+            if timer.cancelled:
+                continue
+
+            if timer.period:
+                timer.deadline += timer.period
+                if timer.deadline <= now:
+                    skipped = int((now - timer.deadline) // timer.period) + 1
+                    timer.missed += skipped
+                    timer.deadline += skipped * timer.period
+                heapq.heappush(self.heap, timer)
+            else:
+                self.timers.pop(timer.id, None)
+
+            timer.fired += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                logger.info("Timer {} callback failed due: {}".format(timer.id, e.__repr__()))
+
+        self.arm()
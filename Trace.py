@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# File layout : MAGIC, then one record per signal
+#   header  <dBBHI : seconds since start, payload kind, realm length, verb length, payload length
+#   body    realm bytes, verb bytes, payload bytes
+# The DERIVED bit of the kind byte marks signals raised by a running state : replaying the
+# inputs raises them again
+MAGIC = b'VTRC\x01'
+HEADER = struct.Struct('<dBBHI')
+
+# Payload kinds
+PNONE, PSTR, PLIST, PBYTES, POPAQUE = range(5)
+DERIVED = 0x80
+LIST_SEP = '\x1f'
+
+# Verbs that only make sense inside the live process. The signals fired by a TIMER are in the trace
+SKIP_VERBS = ('EXIT', 'SCRIPTSTEPS', 'SCRIPTEND', 'TRACE', 'TIMER')
+
+
+def encodePayload(payload):
+    if payload is None:
+        return PNONE, b''
+    if isinstance(payload, str):
+        return PSTR, payload.encode('utf8')
+    if isinstance(payload, (bytes, bytearray)):
+        return PBYTES, bytes(payload)
+    if isinstance(payload, list) and all(isinstance(p, str) for p in payload):
+        return PLIST, LIST_SEP.join(payload).encode('utf8')
+    return POPAQUE, repr(payload).encode('utf8')
+
+def decodePayload(kind, data):
+    if kind == PNONE:
+        return None
+    if kind == PBYTES:
+        return data
+    text = data.decode('utf8')
+    if kind == PLIST:
+        return text.split(LIST_SEP) if text else []
+    return text
+
+
+class TraceRecorder:
+
+    # Append only binary log of every signal given to RunSM.registerSignal
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        self.records = 0
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.fobj = open(path, 'ab')
+        if new:
+            self.fobj.write(MAGIC)
+
+    def record(self, realm, verb, payload, derived=False):
+        kind, pdata = encodePayload(payload)
+        if derived:
+            kind |= DERIVED
+        rdata = realm.encode('utf8')[:255]
+        vdata = verb.encode('utf8')
+        ts = time.perf_counter() - self.t0
+        with self.lock:
+            self.fobj.write(HEADER.pack(ts, kind, len(rdata), len(vdata), len(pdata)))
+            self.fobj.write(rdata)
+            self.fobj.write(vdata)
+            self.fobj.write(pdata)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            self.fobj.close()
+
+
+def readTrace(path) -> list:
+    # [(ts, realm, verb, payload, derived), ...] ; timestamps restart at 0 for each appended session
+    records = []
+    with open(path, 'rb') as fobj:
+        data = fobj.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('{} is not a signal trace'.format(path))
+
+    pos = len(MAGIC)
+    while pos + HEADER.size <= len(data):
+        ts, kind, rlen, vlen, plen = HEADER.unpack_from(data, pos)
+        pos += HEADER.size
+        realm = data[pos:pos + rlen].decode('utf8')
+        pos += rlen
+        verb = data[pos:pos + vlen].decode('utf8')
+        pos += vlen
+        payload = decodePayload(kind & ~DERIVED, data[pos:pos + plen])
+        pos += plen
+        records.append((ts, realm, verb, payload, bool(kind & DERIVED)))
+    return records
+
+
+class TraceReplay:
+
+    # Feeds the external inputs of a trace into a RunSM wired to stub transports, either at the
+    # recorded pace or as fast as possible, and times every signal from registerSignal to idle stack.
+    # Derived signals are left out unless asked for, the replayed states raise them again
+
+    def __init__(self, records, seed=0, derived=False):
+        self.records = [r for r in records if r[2] not in SKIP_VERBS and (derived or not r[4])]
+        self.seed = seed
+
+    def run(self, timed=False) -> dict:
+        # Stubs pulls RunSM in, keep it out of the recorder import path
+        from Stubs import buildStubStack
+        from BSP import DISPATCH, Signal
+
+        random.seed(self.seed)
+        sm = buildStubStack(DISPATCH.ASYNC)
+        for name in ('RunSM', 'PSerial', 'TCPServer', 'Instrument'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+        loop = asyncio.new_event_loop()
+        sm.eventloop = loop
+        sm.bridge.bind(loop)
+        sm.timers.bind(loop)
+        sm.runBatch()
+
+        latencies = []
+
+        async def feed():
+            start = loop.time()
+            for n, (ts, realm, verb, payload, _) in enumerate(self.records):
+                if timed:
+                    delay = start + ts - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                elif n % 64 == 0:
+                    await asyncio.sleep(0)
+
+                t0 = time.perf_counter()
+                sm.registerSignal(Signal(None, verb=verb, payload=payload))
+                while not sm.signal_queue.empty():
+                    sm.runBatch()
+                latencies.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        loop.run_until_complete(feed())
+        wall = time.perf_counter() - t0
+        loop.close()
+
+        latencies.sort()
+        n = len(latencies)
+        pick = lambda p: latencies[min(n - 1, int(n * p / 100))] * 1e6 if n else 0.0
+        return {
+            'signals'       : n,
+            'wall_s'        : wall,
+            'signals_per_s' : n / wall if wall > 0 else 0.0,
+            'p50_us'        : pick(50),
+            'p99_us'        : pick(99),
+            'max_us'        : latencies[-1] * 1e6 if n else 0.0,
+            'serial_bytes'  : sm.pserial.transport.nbytes,
+            'console_bytes' : sum(s.transport.nbytes for s in sm.sessions.values()),
+        }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Signal trace tools')
+    parser.add_argument('cmd', choices=['dump', 'replay'])
+    parser.add_argument('path')
+    parser.add_argument('--timed', action='store_true', help='replay at the recorded pace')
+    parser.add_argument('--derived', action='store_true',
+                        help='also replay the signals raised by running states')
+    args = parser.parse_args()
+
+    records = readTrace(args.path)
+    if args.cmd == 'dump':
+        for ts, realm, verb, payload, derived in records:
+            print('{:>12.6f}  {:<8} {:1} {:<16} {!r}'.format(ts, realm, '*' if derived else '', verb, payload))
+    else:
+        report = TraceReplay(records, derived=args.derived).run(args.timed)
+        for key, value in report.items():
+            print('{:<14} {}'.format(key, round(value, 3) if isinstance(value, float) else value))
@@ -1,9 +1,9 @@
 
-import logging, re
+import logging, re, os
 from datetime import datetime
 import time
 import locale
-import jsons, json
+import json
 
 
 logger = logging.getLogger(__name__)
@@ -89,7 +89,17 @@ def get_class( kls ):
     return m
 
 
+def findFile(directory, name, what='file') -> str:
+    # The console upper cases everything, so match file names case insensitively
+    for fname in os.listdir(directory):
+        if fname.upper() == name or os.path.splitext(fname)[0].upper() == name:
+            return os.path.join(directory, fname)
+    raise FileNotFoundError('no {} {} in {}'.format(what, name, directory))
+
+
 def pprintJson (obj):
+    # jsons is only needed here, keep it out of the state machine import path
+    import jsons
 
     jobj = json.loads(jsons.dumps(obj))
     dumped = json.dumps(jobj, indent=4)
@@ -106,6 +116,7 @@ def saveJson (obj, path):
         logger.debug('Failed to save JSON {} due {}'.format(path, e.__repr__()))
 
 def loadJson (path, obj):
+    import jsons
 
     try:
         with open(path, 'rt') as fhandle:
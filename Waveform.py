@@ -0,0 +1,105 @@
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+# Parameters of every waveform kind and their defaults. Any kind also takes
+#   noise : standard deviation of a gaussian overlay (0 = none)    seed : noise generator seed
+KINDS = {
+    'SINE'      : {'n': 40, 'amp': 10000, 'offset': 20000, 'periods': 1},
+    'RAMP'      : {'n': 40, 'start': 10000, 'stop': 30000},
+    'STEP'      : {'n': 40, 'low': 10000, 'high': 30000, 'at': 0.5},
+    'PUMPDOWN'  : {'n': 400, 'start': 1000000, 'floor': 64000, 'tau': 0.2},
+    'BUILDUP'   : {'n': 400, 'floor': 64000, 'top': 1000000, 'tau': 0.2},
+    'FILE'      : {'n': 0, 'path': ''},
+}
+OVERLAYS = {'noise': 0, 'seed': 0}
+
+
+class WaveformLibrary:
+
+    # Sample tables for SENDBLOCK, generated vectorised with NumPy and memoized by kind and
+    # parameters in a small LRU. Tables are int64 and read only, so they are shared safely.
+    # tau and at are fractions of the table length
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+
+    def params(self, kind, **params) -> dict:
+        # Defaults merged with params, names checked
+        if kind not in KINDS:
+            raise ValueError('unknown waveform {}, expected one of {}'.format(kind, ' '.join(KINDS)))
+        merged = dict(KINDS[kind], **OVERLAYS)
+        for name, value in params.items():
+            if name not in merged:
+                raise ValueError('{} takes {}'.format(kind, ' '.join(merged)))
+            merged[name] = value if name == 'path' else float(value)
+        return merged
+
+    def table(self, kind, **params) -> np.ndarray:
+        merged = self.params(kind, **params)
+        key = (kind,) + tuple(sorted(merged.items()))
+        if kind == 'FILE':
+            # A rewritten recording is a new table
+            key += (os.path.getmtime(merged['path']),)
+
+        table = self.cache.get(key)
+        if table is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return table
+
+        self.misses += 1
+        table = self.generate(kind, merged)
+        table.flags.writeable = False
+        self.cache[key] = table
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return table
+
+
+    def generate(self, kind, p) -> np.ndarray:
+        if kind == 'FILE':
+            y = self.load(p['path'])
+            if p['n']:
+                # Resample the recording to n points
+                y = np.interp(np.linspace(0, len(y) - 1, int(p['n'])), np.arange(len(y)), y)
+        else:
+            n = int(p['n'])
+            t = np.arange(n) / n
+            if kind == 'SINE':
+                y = p['offset'] + p['amp'] * np.sin(2 * np.pi * p['periods'] * t)
+            elif kind == 'RAMP':
+                y = np.linspace(p['start'], p['stop'], n)
+            elif kind == 'STEP':
+                y = np.where(t < p['at'], p['low'], p['high'])
+            elif kind == 'PUMPDOWN':
+                y = p['floor'] + (p['start'] - p['floor']) * np.exp(-t / p['tau'])
+            else:
+                y = p['floor'] + (p['top'] - p['floor']) * (1 - np.exp(-t / p['tau']))
+
+        if p['noise']:
+            y = y + np.random.default_rng(int(p['seed'])).normal(0.0, p['noise'], len(y))
+        return np.asarray(y).astype(np.int64)
+
+    @staticmethod
+    def load(path) -> np.ndarray:
+        # .npy arrays, or text with one value per line (or any whitespace / comma separated values)
+        if path.endswith('.npy'):
+            return np.load(path).ravel()
+        with open(path) as fobj:
+            text = fobj.read().replace(',', ' ')
+        return np.array(text.split(), dtype=np.float64)
+
+
+    def describe(self) -> str:
+        return 'Waveform tables cached {} / {}, hits {}, misses {}'.format(
+                    len(self.cache), self.maxsize, self.hits, self.misses)
@@ -1,15 +1,20 @@
+import argparse
 import asyncio
+import functools
 import serial_asyncio
 import time
 import logging
 from queue import Queue
 
 from pydispatch import dispatcher
-from BSP import SMStates, SIGNALS, ENTITIES
+from BSP import SMStates, SIGNALS, ENTITIES, DISPATCH
 from Instrument import Instrument
 from RunSM import RunSM
+from Stubs import StubTransport
+from Trace import TraceRecorder
 
 
+from MachineServer import MachineSession
 from PSerial import PSerial
 from TCPServer import TCPServer
 
@@ -58,25 +63,68 @@ class LogQueue:
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Virna CLI Calc Server')
+    parser.add_argument('--dispatch', choices=['thread', 'async', 'realms'], default='thread',
+                        help='RunSM dispatcher : 100ms polling thread, event driven on the asyncio loop '
+                             'or one worker thread per realm')
+    parser.add_argument('--batch', type=int, default=32,
+                        help='Max signals admitted per dispatcher tick (0 = drain all)')
+    parser.add_argument('--queue', type=int, default=1024,
+                        help='Signal queue bound (0 = unbounded)')
+    parser.add_argument('--trace', default=None,
+                        help='Record every signal to this trace file (replay with Trace.py)')
+    parser.add_argument('--history', default=None,
+                        help='Console history shared by all sessions and kept in this file (recall with !Sn)')
+    parser.add_argument('--listen', action='append', default=None,
+                        help='Console listener, tcp:host:port or unix:path. Repeat for several '
+                             '(default tcp:127.0.0.1:8888)')
+    parser.add_argument('--machine', action='append', default=None,
+                        help='JSON lines machine protocol listener, same forms as --listen '
+                             '(default tcp:127.0.0.1:8889, none to disable)')
+    parser.add_argument('--write-high', type=int, default=64 * 1024,
+                        help='Console sessions write buffer high watermark, bytes (low is a quarter)')
+    parser.add_argument('--slow-timeout', type=float, default=30.0,
+                        help='Close sessions that stay over the high watermark this long, seconds')
+    parser.add_argument('--slow-policy', choices=['drop', 'close'], default='drop',
+                        help='When a stalled session has parked too much output : drop it or close the session')
+    parser.add_argument('--serial', default='/dev/ttyUSB1',
+                        help='Serial device, or stub to run without one (load tests, LoadGen.py)')
+    args = parser.parse_args()
+
     configLogger(None)
 
     loop = asyncio.get_event_loop()
 
     tcps = TCPServer()
-    server = loop.create_server(lambda: tcps, '127.0.0.1', 8888)
-    loop.run_until_complete(server)
+    tcps.write_high = args.write_high
+    tcps.write_low = args.write_high // 4
+    tcps.slow_timeout = args.slow_timeout
+    tcps.slow_policy = args.slow_policy.upper()
+    if args.history is not None:
+        tcps.setHistory(args.history)
+    for spec in args.listen or ['tcp:127.0.0.1:8888']:
+        loop.run_until_complete(tcps.listen(loop, spec))
+    for spec in args.machine or ['tcp:127.0.0.1:8889']:
+        if spec != 'none':
+            loop.run_until_complete(tcps.listen(loop, spec, functools.partial(MachineSession, tcps)))
 
     pserial1 = PSerial()
-    pserial = serial_asyncio.create_serial_connection(loop, lambda: pserial1, '/dev/ttyUSB1', baudrate=115200)
-    loop.run_until_complete(pserial)
+    if args.serial == 'stub':
+        pserial1.transport = StubTransport(('serial', 0))
+    else:
+        pserial = serial_asyncio.create_serial_connection(loop, lambda: pserial1, args.serial, baudrate=115200)
+        loop.run_until_complete(pserial)
 
     instrument = Instrument()
 
-    sm = RunSM(None, pserial1, tcps, instrument)
+    dispatch = {'thread': DISPATCH.THREAD, 'async': DISPATCH.ASYNC, 'realms': DISPATCH.REALMS}[args.dispatch]
+    sm = RunSM(None, pserial1, tcps, instrument, dispatch, args.batch, args.queue)
     pserial1.setRunSM(sm)
     tcps.setRunSM(sm)
     instrument.setRunSM(sm)
     pserial1.setInstrument(instrument)
+    if args.trace is not None:
+        sm.recorder = TraceRecorder(args.trace)
 
 
 